@@ -1,15 +1,20 @@
 # To generate executable:
 #   pyinstaller --add-data OutputExcelTemplate_v09_20200922.xlsm;. --onedir NoiseDataProcessor_ui.py
+#
+# pipeline (and with it pandas, numpy and openpyxl) isn't imported at module load, so the window shows quickly: it's
+# imported in the background once the window is shown, or on first use of "Process data" if that hasn't finished.
+# Startup import times: python benchmark.py startup
 
 import sys
-from PyQt5.QtWidgets import QApplication, QMainWindow, QPushButton, QVBoxLayout, QWidget, QFileDialog, QMessageBox
-from PyQt5.QtCore import QCoreApplication
-import infer_filetype
-from read_data import read
-from process import *
-import outputs_ui
+from PyQt5.QtWidgets import QApplication, QMainWindow, QPushButton, QVBoxLayout, QWidget, QFileDialog, QMessageBox, \
+    QLabel, QProgressBar
+from PyQt5.QtCore import QCoreApplication, QThread, QTimer, pyqtSignal
+from traceback import format_exc
+from threading import Thread
+from importlib import import_module
 from os import startfile
-from json import dumps
+import profiling
+from multiprocessing import freeze_support
 
 __version__ = "0.1"
 __author__ = "Peter Ling"
@@ -24,7 +29,7 @@ class NoiseDataProcessorUi(QMainWindow):
         super().__init__()
         # Set some main window's properties
         self.setWindowTitle("Noise Data Processor")
-        self.setFixedSize(300, 150)
+        self.setFixedSize(300, 220)
         # Set the central widget and the general layout
         self.generalLayout = QVBoxLayout()
         self._centralWidget = QWidget(self)
@@ -32,6 +37,8 @@ class NoiseDataProcessorUi(QMainWindow):
         self._centralWidget.setLayout(self.generalLayout)
         # Create the buttons
         self._create_buttons()
+        # Create the progress display
+        self._create_progress()
 
     def _create_buttons(self):
         """Create the buttons."""
@@ -51,6 +58,93 @@ class NoiseDataProcessorUi(QMainWindow):
         # Add buttons_layout to the general layout
         self.generalLayout.addLayout(buttons_layout)
 
+    def _create_progress(self):
+        """Create the progress label, bar and cancel button (hidden until processing starts)."""
+        self.status = QLabel("")
+        self.progress = QProgressBar()
+        self.progress.setVisible(False)
+        self.buttons["Cancel"] = QPushButton("Cancel")
+        self.buttons["Cancel"].setVisible(False)
+        self.generalLayout.addWidget(self.status)
+        self.generalLayout.addWidget(self.progress)
+        self.generalLayout.addWidget(self.buttons["Cancel"])
+
+    def set_busy(self, busy):
+        """Enable/disable the buttons and show/hide the progress bar while processing."""
+        for btnText, button in self.buttons.items():
+            button.setEnabled(busy if btnText == "Cancel" else not busy)
+        self.buttons["Cancel"].setVisible(busy)
+        self.progress.setVisible(busy)
+
+    def show_progress(self, stage, done, total):
+        """Show current stage, with busy indicator if total is unknown (0)."""
+        self.status.setText(stage + ("..." if total == 0 else " ({} of {})".format(done, total)))
+        self.progress.setRange(0, total)
+        self.progress.setValue(done)
+
+
+class Cancelled(Exception):
+    """Raised in the worker thread from the progress function when processing is cancelled."""
+
+
+def preload():
+    """Import pipeline in a background thread (a later import waits for it to finish)."""
+    Thread(target=import_module, args=("pipeline",), daemon=True).start()
+
+
+def run_pipeline(config, profile, progress=None):
+    """Import pipeline if not yet loaded, then read, process and summarise data and prepare Excel export."""
+    if progress:
+        progress("Loading libraries", 0, 0)
+    import pipeline
+    return pipeline.run(config, progress=progress, profile=profile)
+
+
+def save_output(writer, config, config_out, profile, progress=None):
+    """Export workbook, config file and profile report (if profiling)."""
+    import pipeline
+    pipeline.save(writer, config, config_out, progress=progress, profile=profile)
+
+
+# Run a pipeline function off the GUI thread, so the window stays responsive
+class PipelineWorker(QThread):
+    """Worker thread running func(*args, progress=...) from pipeline.
+
+    Emits progress(stage, done, total) as the pipeline reports it, then one of done(result),
+    failed(exception, traceback) or cancelled(). Cancellation is cooperative: the next progress
+    report after cancel() raises Cancelled, which unwinds the pipeline.
+    """
+
+    progress = pyqtSignal(str, int, int)
+    done = pyqtSignal(object)
+    failed = pyqtSignal(object, str)
+    cancelled = pyqtSignal()
+
+    def __init__(self, func, *args):
+        """Worker initializer."""
+        super().__init__()
+        self._func = func
+        self._args = args
+        self._cancel = False
+
+    def cancel(self):
+        self._cancel = True
+
+    def _progress(self, stage, done, total):
+        if self._cancel:
+            raise Cancelled()
+        self.progress.emit(stage, done, total)
+
+    def run(self):
+        try:
+            result = self._func(*self._args, progress=self._progress)
+        except Cancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            self.failed.emit(e, format_exc())
+        else:
+            self.done.emit(result)
+
 
 # Create a Controller class to connect the GUI and the model
 class NoiseDataProcessorCtrl:
@@ -60,6 +154,9 @@ class NoiseDataProcessorCtrl:
         """Controller initializer."""
         self._config = config
         self._view = view
+        self._worker = None
+        self._prepared = None
+        self._profile = None
         # Connect signals and slots
         self._connect_signals()
 
@@ -127,60 +224,66 @@ class NoiseDataProcessorCtrl:
                 self._incomplete_config_dialog(f)
                 return
 
-        # Infer file type if config set to auto
-        if config["type"] == "auto":
-            file_type = infer_filetype.infer(config["input"][0])
-            print("\nInferred file type: " + file_type)
-        else:
-            file_type = config["type"]
-
-        # Read input data
-        print("Reading data...")
-        user_metadata = config["percentiles"].copy()
-        user_metadata.insert(0, config["frequency weighting"])
-
-        if 'columns' in config.keys():
-            data, metadata = read(file_type, config["input"], user_metadata, columns=config["columns"])
-        else:
-            data, metadata = read(file_type, config["input"], user_metadata)
-
-        print("Data read successfully")
-
-        # Run pre-processing modules
-        data, _ = process_batch(data, config["modules"], metadata)
-
-        # Generate output tables
-        tables = outputs_ui.daily_table(
-            data,
-            metadata["Frequency Weighting"],
-            config["lmax summary remove"],
-            config["lmax summary override"]
-        )
-
-        # Export to Excel (also export config duplicate)
-        writer, config_out = outputs_ui.export_excel(data, metadata, tables, config)
-
-        while True:
-            try:
-
-                # Export workbook
-                writer.save()
-
-                # Export config file
-                with open(config_out, 'w') as file:
-                    file.write(dumps(config, indent=4))
-
-                print("Export complete")
+        # Read, process and summarise data, and prepare Excel export, in worker thread
+        self._view.set_busy(True)
+        self._prepared = None
+        self._profile = profiling.start(config)
+        self._start_worker(run_pipeline, config, self._profile, on_done=self._run_done)
+
+    def _run_done(self, result):
+        """Save the prepared output, or report that there was nothing new to process."""
+        if result is None:
+            self._reset()
+            self._no_new_data_dialog()
+            return
 
-                startfile(config["output"][0] + ".xlsm")
+        self._prepared = result
+        self._save()
+
+    def _save(self):
+        """Export workbook and config file in worker thread."""
+        writer, config_out = self._prepared
+        self._start_worker(save_output, writer, self._config, config_out, self._profile, on_done=self._save_done)
+
+    def _save_done(self, result):
+        startfile(self._config["output"][0] + ".xlsm")
+        QCoreApplication.quit()
+
+    def _start_worker(self, func, *args, on_done):
+        """Run func(*args) in a new worker thread, calling on_done(result) on the GUI thread if it succeeds."""
+        # Previous worker (if any) has emitted its result, but wait for its thread to exit before replacing it
+        if self._worker is not None:
+            self._worker.wait()
+        self._worker = PipelineWorker(func, *args)
+        self._worker.progress.connect(self._view.show_progress)
+        self._worker.done.connect(on_done)
+        self._worker.failed.connect(self._worker_failed)
+        self._worker.cancelled.connect(self._reset)
+        self._worker.start()
+
+    def _cancel(self):
+        self._view.status.setText("Cancelling...")
+        self._view.buttons["Cancel"].setEnabled(False)
+        self._worker.cancel()
+
+    def _worker_failed(self, error, trace):
+        """Ask to retry saving if output file is open, otherwise show the error and return to the main window."""
+        # Only the save worker writes the output workbook; other permission errors (e.g. locked cache or input
+        # files) come from run_pipeline, before there is anything prepared to save
+        if isinstance(error, PermissionError) and (self._prepared is not None):
+            action = self._file_open_dialog()
+            if action == 4194304:
                 QCoreApplication.quit()
-                break
+            else:
+                self._save()
+            return
+
+        self._reset()
+        self._error_dialog(error, trace)
 
-            except PermissionError:
-                action = self._file_open_dialog()
-                if action == 4194304:
-                    QCoreApplication.quit()
-                    break
+    def _reset(self):
+        self._view.set_busy(False)
+        self._view.status.setText("")
 
     def _connect_signals(self):
         """Connect signals and slots."""
@@ -188,6 +291,7 @@ class NoiseDataProcessorCtrl:
         self._view.buttons["Select/override input file..."].clicked.connect(self._input_select)
         self._view.buttons["Select/override output file..."].clicked.connect(self._output_select)
         self._view.buttons["Process data"].clicked.connect(self._process_data)
+        self._view.buttons["Cancel"].clicked.connect(self._cancel)
 
     def _no_input_dialog(self):
         msg = QMessageBox()
@@ -210,6 +314,21 @@ class NoiseDataProcessorCtrl:
         msg.setIcon(QMessageBox.Critical)
         msg.exec_()
 
+    def _no_new_data_dialog(self):
+        msg = QMessageBox()
+        msg.setWindowTitle("No new data")
+        msg.setText("All input files have already been processed")
+        msg.setIcon(QMessageBox.Information)
+        msg.exec_()
+
+    def _error_dialog(self, error, trace):
+        msg = QMessageBox()
+        msg.setWindowTitle("Error")
+        msg.setText("Processing failed: " + str(error))
+        msg.setDetailedText(trace)
+        msg.setIcon(QMessageBox.Critical)
+        msg.exec_()
+
     def _file_open_dialog(self):
         msg = QMessageBox()
         msg.setWindowTitle("File open")
@@ -233,6 +352,8 @@ def main():
     # Show the calculator's GUI
     view = NoiseDataProcessorUi()
     view.show()
+    # Load processing libraries once the window is shown
+    QTimer.singleShot(0, preload)
     # Create instances of the model and the controller
     config = {}
     ctrl = NoiseDataProcessorCtrl(config=config, view=view)
@@ -241,4 +362,6 @@ def main():
 
 
 if __name__ == "__main__":
+    # Required for process pools in frozen (PyInstaller) executable
+    freeze_support()
     main()
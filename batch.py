@@ -0,0 +1,220 @@
+# Headless batch processing of many surveys, each set up by its own config file (as loaded in the GUI)
+#   - Surveys processed in parallel on a process pool, each through pipeline.run() and pipeline.save()
+#   - A failing survey is reported and doesn't stop the rest
+#
+# Usage:
+#   python batch.py configs/                        all config files (*.txt) in folder
+#   python batch.py a.txt b.txt --workers 4         given config files, four surveys at a time
+#   python batch.py --manifest surveys.txt          config files listed in manifest, one per line
+#   python batch.py configs/ --explain              print each survey's module plan, without processing
+
+import argparse
+import sys
+from os import path, listdir
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import freeze_support
+from traceback import format_exc
+from time import time
+import pipeline
+import profiling
+import process
+
+
+def config_files(paths, manifest=None):
+
+    """
+
+    Returns list of config files from paths (config files or folders of them) and manifest file (one config file
+    per line, relative to manifest's folder; blank lines and lines starting with # are ignored)
+
+    """
+
+    files = []
+    for p in paths:
+        if path.isdir(p):
+            files += sorted(path.join(p, f) for f in listdir(p) if f.endswith('.txt'))
+        else:
+            files.append(p)
+
+    if manifest:
+        with open(manifest, 'r') as file:
+            for line in file:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    files.append(path.join(path.dirname(manifest), line))
+
+    return files
+
+
+def run_survey(config_file, serial_read=False):
+
+    """
+
+    Processes survey set up by config file, returning dict of status ('OK', 'No new data' or 'Failed'), total time and
+    time of each stage (s), and error traceback if failed
+
+    :param serial_read  : Read each survey's files in one process (i.e. ignore config "workers"), as surveys are
+                          already processed in parallel
+
+    """
+
+    result = {'config': config_file, 'status': 'Failed', 'timings': {}, 'error': None}
+    t = time()
+
+    try:
+
+        config = eval(open(config_file, 'r').read())
+
+        if serial_read:
+            config["workers"] = 1
+
+        profile = profiling.start(config)
+        prepared = pipeline.run(config, result['timings'], profile=profile)
+
+        if prepared is None:
+            result['status'] = 'No new data'
+        else:
+            t_save = time()
+            pipeline.save(prepared[0], config, prepared[1], profile=profile)
+            result['timings']['save'] = time() - t_save
+            result['status'] = 'OK'
+
+    except Exception:
+        result['error'] = format_exc()
+
+    result['time'] = time() - t
+
+    return result
+
+
+def run_batch(files, workers=1):
+
+    """
+
+    Processes surveys for each config file, printing a line for each (in order of files) and a summary at the end
+
+    :return             : List of run_survey() results, in order of files
+
+    """
+
+    t = time()
+
+    if workers > 1:
+        results = []
+        for result in run_parallel(files, workers):
+            results.append(result)
+            report(results[-1])
+    else:
+        results = []
+        for f in files:
+            results.append(run_survey(f))
+            report(results[-1])
+
+    n_ok = sum(r['status'] != 'Failed' for r in results)
+    print("\n{} of {} surveys processed in {:.1f} s".format(n_ok, len(results), time() - t))
+    for r in results:
+        if r['status'] == 'Failed':
+            print("Failed: " + r['config'])
+
+    return results
+
+
+def run_parallel(files, workers):
+
+    """
+
+    Yields run_survey() result for each config file, in order of files, processing surveys on a pool of worker
+    processes
+
+    If a worker process dies (e.g. killed when out of memory, or a crash in native code), the pool breaks and can't
+    tell which survey caused it: surveys already finished keep their results, the first unfinished survey is run again
+    on its own (and recorded as failed if it breaks that pool too) and the rest are resubmitted to a fresh pool
+
+    """
+
+    results = {}
+    pending = list(range(len(files)))
+    n_yielded = 0
+
+    while pending:
+
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [(i, pool.submit(run_survey, files[i], True)) for i in pending]
+            for i, future in futures:
+                try:
+                    results[i] = future.result()
+                except BrokenProcessPool:
+                    continue
+                except Exception:
+                    results[i] = failed(files[i], format_exc())
+                while n_yielded in results:
+                    yield results[n_yielded]
+                    n_yielded += 1
+
+        pending = [i for i in pending if i not in results]
+        if pending:
+            i = pending.pop(0)
+            results[i] = run_isolated(files[i])
+            while n_yielded in results:
+                yield results[n_yielded]
+                n_yielded += 1
+
+
+def run_isolated(config_file):
+
+    """
+
+    Returns run_survey() result for config file processed in its own worker process, or a failed result if the
+    process dies
+
+    """
+
+    try:
+        with ProcessPoolExecutor(1) as pool:
+            return pool.submit(run_survey, config_file, True).result()
+    except Exception:
+        return failed(config_file, format_exc())
+
+
+def failed(config_file, error):
+
+    return {'config': config_file, 'status': 'Failed', 'timings': {}, 'error': error, 'time': 0.0}
+
+
+def report(result):
+
+    timings = ', '.join('{} {:.1f}'.format(k, v) for k, v in result['timings'].items())
+    print("{:<12}{:>8.1f} s   {}   ({})".format(result['status'], result['time'], result['config'], timings))
+
+    if result['error']:
+        print(result['error'])
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(description="Process noise surveys from config files without the GUI")
+    parser.add_argument('paths', nargs='*', help="Config files, or folders of config files (*.txt)")
+    parser.add_argument('--manifest', help="File listing config files, one per line")
+    parser.add_argument('--workers', type=int, default=1, help="Number of surveys to process in parallel")
+    parser.add_argument('--explain', action='store_true', help="Print module plan of each survey and exit")
+    args = parser.parse_args(args)
+
+    files = config_files(args.paths, args.manifest)
+
+    if not files:
+        parser.error("No config files given")
+
+    if args.explain:
+        for f in files:
+            print(f + "\n" + process.explain(eval(open(f, 'r').read())["modules"]) + "\n")
+        return 0
+
+    results = run_batch(files, args.workers)
+
+    return 1 if any(r['status'] == 'Failed' for r in results) else 0
+
+
+if __name__ == "__main__":
+    freeze_support()
+    sys.exit(main())
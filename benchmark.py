@@ -0,0 +1,914 @@
+# Benchmarks for processing functions, run as a script:
+#   python benchmark.py resample [days] [input resolution]
+#   python benchmark.py startup [number of packages listed]
+#   python benchmark.py pipeline [days] [input resolution] [survey kinds...]
+#   python benchmark.py golden [update | compact]
+#   python benchmark.py chunked [days]
+#
+# pipeline and golden generate synthetic surveys in the formats read by read_data (NL-32 / NL-52 RND files, on
+# their own or found from RNH metadata files, DUO broadband / third-octave workbooks and custom CSV) and process them
+# with pipeline.run(); golden checks the results against GOLDEN_FILE, so should be run after any change that could
+# affect processed data or summary tables; chunked checks custom CSV files read in chunks against the whole file
+
+import sys
+import subprocess
+import json
+from os import path, chdir, makedirs
+from io import StringIO
+from contextlib import redirect_stdout
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from numpy import log10, random, arange, nanmax, number, isclose, flatnonzero, abs as np_abs
+from pandas import date_range, DataFrame, to_timedelta
+from pandas.tseries.offsets import BusinessHour, Hour
+import process
+
+OCTAVE_BANDS = [63, 125, 250, 500, 1000, 2000, 4000, 8000]
+THIRD_OCTAVE_BANDS = [
+    12.5, 16, 20, 25, 31.5, 40, 50, 63, 80, 100, 125, 160, 200, 250, 315, 400, 500, 630, 800, 1000, 1250, 1600,
+    2000, 2500, 3150, 4000, 5000, 6300, 8000, 10000, 12500, 16000, 20000
+]
+PERCENTILES = (5, 10, 50, 90, 95)
+
+# Synthetic survey kinds: file type read by read_data.read()
+SURVEYS = {
+    'nl32': 'nl32_data',
+    'nl52': 'nl52_data',
+    'nl32_rnh': 'nl32_metadata',
+    'nl52_rnh': 'nl52_metadata',
+    'duo': 'duo_metadata',
+    'duo_octave': 'duo_octave_metadata',
+    'custom_csv': 'custom_csv',
+}
+
+# Spectral-only DUO data has no broadband Leq for outputs_ui.daily_table(), so is only read and pre-processed
+TABLES_UNSUPPORTED = ['duo_octave']
+
+GOLDEN_FILE = path.join(path.dirname(path.abspath(__file__)), 'benchmark_golden.json')
+GOLDEN_DAYS = 3
+GOLDEN_RESOLUTION = '5T'
+
+# Leading modules and chunk sizes (rows) checked by chunked()
+CHUNKED_MODULES = [
+    [['Regularise', ['1T', 'True']]],
+    [['Regularise', ['1T', 'False']], ['Re-sample', ['15T', 10, 'mean']]],
+    [['Regularise', ['1T', 'True']], ['Re-sample', ['5T', 0, 'mode']], ['Re-sample', ['1H', 2, 'lq']]],
+    [['Re-sample', ['15T', 10, 'mean']]],
+    [],
+]
+CHUNK_SIZES = [7, 40, 997]
+
+
+def synthetic_data(days=365, resolution='1T', spectral=True, f_weight='A', seed=0, percentiles=(10, 90),
+                   bands=OCTAVE_BANDS):
+
+    """
+
+    Returns standard format DataFrame of random levels at fixed resolution, as output by read_data.read()
+    and process.regularise_noise(), with Leq and Lmax spectra in given bands (Hz) if spectral
+
+    """
+
+    rng = random.RandomState(seed)
+    idx = date_range('2020-01-01', periods=int(to_timedelta(str(days) + 'D') / to_timedelta(resolution)),
+                     freq=resolution, name='Time')
+
+    levels = {
+        'eq': 55,
+        'max': 70,
+        'min': 40,
+    }
+    for p in percentiles:
+        levels[str(p).zfill(2)] = 60 - 0.2 * p
+    bands = bands if spectral else []
+
+    data = DataFrame(index=idx)
+    data['Address'] = arange(len(idx))
+    data['Duration'] = to_timedelta(resolution)
+    for metric, level in levels.items():
+        data['L' + f_weight + metric + '_Main'] = rng.normal(level, 5, len(idx)).round(1)
+        if metric in ['eq', 'max']:
+            for b in bands:
+                data['L' + f_weight + metric + '_' + band_name(b) + '_Hz'] = \
+                    rng.normal(level - 10, 5, len(idx)).round(1)
+
+    return data
+
+
+def band_name(band):
+
+    """
+
+    Returns band's centre frequency (Hz) as in standard column names, e.g. '31.5', '1000'
+
+    """
+
+    return '{:g}'.format(band)
+
+
+def band_label(band, style):
+
+    """
+
+    Returns band label as in NL-52 ('31.5 Hz', '1.25 kHz') or DUO ('1/3 Oct 31.5Hz', '1/3 Oct 1.25kHz') data files
+
+    """
+
+    label = '{:g} kHz'.format(band / 1000) if band >= 1000 else '{:g} Hz'.format(band)
+
+    return label if style == 'nl52' else '1/3 Oct ' + label.replace(' ', '')
+
+
+def level_strings(values):
+
+    """
+
+    Returns list of levels formatted to 0.1 dB as in instrument data files, with blanks for missing values
+
+    """
+
+    return ['' if v != v else '{:.1f}'.format(v) for v in values]
+
+
+def write_nl32(data, file_out, f_weight='A'):
+
+    """
+
+    Writes standard format DataFrame as NL-32 data file (RND): one row per sample, broadband levels only
+
+    """
+
+    main = data.filter(regex='^L' + f_weight + '.*_Main$')
+
+    seconds = data['Duration'].dt.total_seconds().astype(int)
+    out = DataFrame({
+        'Address': data['Address'].values,
+        'Time': data.index.strftime('%Y/%m/%d %H:%M:%S'),
+        'Measurment Time': ['{:02d}:{:02d}:{:02d}'.format(s // 3600, s // 60 % 60, s % 60) for s in seconds],
+    })
+    for c in main.columns:
+        out[c.replace('_Main', '')] = level_strings(main[c].values)
+
+    out.to_csv(file_out, index=False)
+
+
+def write_nl52(data, file_out, percentiles, bands, f_weight='A'):
+
+    """
+
+    Writes standard format DataFrame as NL-52 AUTO_LEQ data file (RND): a block of rows for each sample, with a
+    header and one row per metric (Main, Sub and band levels); LN1-LN5 hold the given five percentiles
+
+    """
+
+    metrics = {
+        'Leq': 'eq',
+        'LE': 'E',
+        'Lmax': 'max',
+        'Lmin': 'min',
+    }
+    for i, p in enumerate(percentiles):
+        metrics['LN' + str(i + 1)] = str(p).zfill(2)
+
+    # Formatted values of each metric row, blank if metric or band not in data
+    seconds = data['Duration'].dt.total_seconds().values.astype(int)
+    blank = [''] * len(data)
+    rows = {}
+    for m, suffix in metrics.items():
+        cols = ['_Main', '_Sub'] + ['_' + band_name(b) + '_Hz' for b in bands]
+        values = [
+            level_strings(data['L' + f_weight + suffix + c].values) if 'L' + f_weight + suffix + c in data.columns
+            else blank for c in cols
+        ]
+        rows[m] = [m + ',' + ','.join(v) + ',' for v in zip(*values)]
+
+    # LE from Leq and measurement time if not in data
+    if 'L' + f_weight + 'E_Main' not in data.columns:
+        le = data['L' + f_weight + 'eq_Main'].values + 10 * log10(seconds)
+        rows['LE'] = ['LE,' + v + ',' + ',' * (len(bands) + 1) for v in level_strings(le)]
+
+    header = ',Main,Sub,' + ','.join(band_label(b, 'nl52') for b in bands) + ','
+    times = data.index.strftime('%Y/%m/%d %H:%M:%S')
+
+    lines = ['CSV,NL-52']
+    for i in range(len(data)):
+        lines += [
+            'Address,' + str(data['Address'].iloc[i]),
+            'Start Time,' + times[i],
+            'Measurement Time,{:02d}:{:02d}:{:02d}'.format(seconds[i] // 3600, seconds[i] // 60 % 60, seconds[i] % 60),
+            header
+        ]
+        lines += [rows[m][i] for m in metrics]
+        lines += ['Over,0,', 'Under,0,']
+
+    with open(file_out, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+
+
+def write_rnh_nl32(file_out, percentiles, f_weight='A'):
+
+    """
+
+    Writes NL-32 metadata file (RNH): one key, value row per setting, with data files (RND) in the same folder
+
+    """
+
+    lines = [
+        'File Name,NL_0001',
+        'Model,NL-32',
+        'Frequency-weight, ' + f_weight,
+        'Time-weight,Fast',
+    ]
+    for i, p in enumerate(percentiles):
+        lines.append('Percentile ' + str(i + 1) + ',' + str(p))
+
+    with open(file_out, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+
+
+def write_rnh_nl52(file_out, percentiles, store, f_weight='A'):
+
+    """
+
+    Writes NL-52 AUTO_LEQ metadata file (RNH): four header rows then one key, value row per setting, with data files
+    (RND) named after the store under the AUTO_LEQ folder beside it
+
+    """
+
+    lines = [
+        'CSV,NL-52',
+        'Model,NL-52',
+        'Serial No,00000001',
+        'Version,1.0',
+        'Store Name,' + store,
+        'Frequency Weighting,' + f_weight,
+        'Time Weighting,Fast',
+    ]
+    for i, p in enumerate(percentiles):
+        lines.append('Percentile ' + str(i + 1) + ',' + str(p))
+
+    with open(file_out, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+
+
+def write_duo(data, file_out, spectral, bands, f_weight='A'):
+
+    """
+
+    Writes standard format DataFrame as DUO workbook (xlsx): metadata rows, band row (7) and header row (9)
+    above the data, with text timestamps and a footer row
+        - broadband : one sheet of Leq, Lmax, Lmin and percentiles
+        - spectral  : one sheet each of Leq and Lmax third-octave bands
+
+    """
+
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+
+    if spectral:
+        sheets = {}
+        for m in ['eq', 'max']:
+            cols = ['L' + f_weight + m + '_' + band_name(b) + '_Hz' for b in bands]
+            sheets['L' + m] = (cols, ['L' + m] * len(cols), [band_label(b, 'duo') for b in bands])
+    else:
+        cols = data.filter(regex='^L' + f_weight + '.*_Main$').columns.to_list()
+        sheets = {'Global': (cols, [c.replace('_Main', '').replace('L' + f_weight, 'L') for c in cols], [])}
+
+    times = data.index.strftime('%d/%m/%y %H:%M:%S:000')
+
+    for title, (cols, header, band_row) in sheets.items():
+
+        ws = wb.create_sheet(title)
+        ws.append(['Report', 'Synthetic survey'])
+        ws.append(['Weighting', f_weight])
+        ws.append(['Start', times[0]])
+        ws.append(['End', times[-1]])
+        ws.append(['Instrument'] + ([None, 'DUO 10001'] if spectral else ['DUO 10001']))
+        ws.append(['Serial', '10001'])
+        ws.append([None] + band_row)
+        ws.append(['Units'] + ['dB'] * len(cols))
+        ws.append(['Period start'] + header)
+
+        values = data[cols].values
+        for t, row in zip(times, values):
+            ws.append([t] + [None if v != v else float(v) for v in row])
+
+        ws.append(['End of data'])
+
+    wb.save(file_out)
+
+
+def write_csv(data, file_out, columns, time_format):
+
+    """
+
+    Writes standard format DataFrame as custom CSV file, with columns renamed as in config "columns"
+
+    """
+
+    out = DataFrame({v: data[k].values for k, v in columns.items() if k != 'Time'})
+    out.insert(0, columns['Time'], data.index.strftime(time_format))
+    out.to_csv(file_out, index=False, float_format='%.1f')
+
+
+def resample(days=365, resolution='1T'):
+
+    """
+
+    Compares process.resample_noise() with the previous merge-based implementation (resample_noise_merge) for
+    several output resolutions and averaging types; prints run times and largest difference between outputs
+
+    """
+
+    data = synthetic_data(days, resolution)
+    print("Re-sample benchmark: " + str(len(data)) + " samples x " + str(len(data.columns)) + " columns")
+
+    for res_out, avg_type in [('15T', 'mean'), ('1H', 'mode'), ('1D', 'lq')]:
+
+        args = [res_out, 10, avg_type, 'A', [10, 90], 'log']
+
+        t0 = perf_counter()
+        data_ref = resample_noise_merge(data, args)[0]
+        t1 = perf_counter()
+        data_out = process.resample_noise(data, args)[0]
+        t2 = perf_counter()
+
+        levels = data_out.filter(regex='^L').columns
+        diff = nanmax(np_abs(data_out[levels].values - data_ref[levels].values))
+
+        print(
+            '    ' + res_out + ', ' + avg_type + ': ' +
+            'merge {:.3f} s, columnar {:.3f} s ({:.1f}x), max difference {:.2g} dB'.format(
+                t1 - t0, t2 - t1, (t1 - t0) / (t2 - t1), diff
+            )
+        )
+
+
+def survey(kind, folder, days=7, resolution='1T', seed=0):
+
+    """
+
+    Writes synthetic survey of given kind (see SURVEYS) to folder, returning config dict to process it with
+    pipeline.run() (output also in folder). NL-32 / NL-52 surveys are split into one data file per day. Surveys
+    read from RNH metadata files are also re-sampled, have an event removed and a user-defined Lmax summary.
+
+    """
+
+    spectral = kind in ['nl52', 'nl52_rnh', 'duo_octave']
+    data = synthetic_data(days, resolution, spectral, seed=seed, percentiles=PERCENTILES, bands=THIRD_OCTAVE_BANDS)
+
+    modules = [
+        ['Regularise', [resolution, 'False']],
+        ['Flag time', ['Day', '01/01/20 07:00', '01/01/20 23:00', [0, 1, 2, 3, 4, 5, 6]]],
+        ['Flag time', ['Night', '01/01/20 23:00', '02/01/20 07:00', [0, 1, 2, 3, 4, 5, 6]]],
+    ]
+
+    config = {
+        'output': [path.join(folder, kind)],
+        'type': SURVEYS[kind],
+        'frequency weighting': 'A',
+        'percentiles': list(PERCENTILES),
+        'lmax summary remove': 10,
+        'lmax summary override': None,
+        'modules': modules,
+    }
+
+    if kind in ['nl32', 'nl52', 'nl32_rnh', 'nl52_rnh']:
+        config['input'] = []
+        for i, (_, data_day) in enumerate(data.groupby(data.index.floor('1D'))):
+            if kind == 'nl52_rnh':
+                makedirs(path.join(folder, 'AUTO_LEQ'), exist_ok=True)
+                file_out = path.join(folder, 'AUTO_LEQ', 'NL_Auto_0001_' + str(i + 1).zfill(4) + '.rnd')
+            else:
+                file_out = path.join(folder, 'NL_' + str(i + 1).zfill(4) + '.rnd')
+            if kind.startswith('nl32'):
+                write_nl32(data_day, file_out)
+            else:
+                write_nl52(data_day, file_out, PERCENTILES, THIRD_OCTAVE_BANDS)
+            config['input'].append(file_out)
+
+        # Data files are found from the metadata file
+        if kind == 'nl32_rnh':
+            config['input'] = [path.join(folder, 'NL_0001.rnh')]
+            write_rnh_nl32(config['input'][0], PERCENTILES)
+        elif kind == 'nl52_rnh':
+            config['input'] = [path.join(folder, 'NL_Auto_0001.rnh')]
+            write_rnh_nl52(config['input'][0], PERCENTILES, 'Auto_0001')
+
+    elif kind in ['duo', 'duo_octave']:
+        config['input'] = [path.join(folder, kind + '.xlsx')]
+        write_duo(data, config['input'][0], spectral, THIRD_OCTAVE_BANDS)
+
+    else:
+        config['input'] = [path.join(folder, kind + '.csv')]
+        config['columns'] = {'Time': 'Timestamp', 'LAeq_Main': 'LAeq', 'LAmax_Main': 'LAmax', 'LAmin_Main': 'LAmin'}
+        for p in PERCENTILES:
+            config['columns']['LA' + str(p).zfill(2) + '_Main'] = 'LA' + str(p).zfill(2)
+        config['time format'] = '%d/%m/%Y %H:%M:%S'
+        write_csv(data, config['input'][0], config['columns'], config['time format'])
+
+    # Re-sample to 15 minutes, remove an afternoon event and override the summary Lmax
+    if kind in ['nl32_rnh', 'nl52_rnh']:
+        modules.insert(1, ['Re-sample', ['15T', 1, 'mean' if kind == 'nl32_rnh' else 'mode']])
+        modules.append(['Flag time', ['Event', '02/01/20 12:00', '02/01/20 16:00', False]])
+        modules.append(['Remove time', ['Event']])
+        config['lmax summary override'] = {'Day': 72, 'Night': 68}
+
+    # Octave bands from third-octaves for NL-52, whose levels are grouped by their Main column
+    if kind in ['nl52', 'nl52_rnh']:
+        modules.append(['Convert to octaves', []])
+
+    return config
+
+
+def pipeline_stages(days=7, resolution='1T', *kinds):
+
+    """
+
+    Generates synthetic survey of each kind (all in SURVEYS by default) and runs it through pipeline.run() and
+    pipeline.save(), printing time to generate files and time of each stage (read, each module, tables, export,
+    save), from profiling.Profile without memory tracing
+
+    """
+
+    import pipeline
+    import profiling
+
+    for kind in kinds or SURVEYS:
+
+        with TemporaryDirectory() as folder:
+
+            t0 = perf_counter()
+            config = survey(kind, folder, days, resolution)
+            t_gen = perf_counter() - t0
+
+            profile = profiling.Profile(memory=False)
+            with redirect_stdout(StringIO()):
+                if kind in TABLES_UNSUPPORTED:
+                    read_and_process(config, profile)
+                else:
+                    writer, config_out = pipeline.run(config, profile=profile)
+                    pipeline.save(writer, config, config_out, profile=profile)
+
+        rows = max(s.get('rows out', 0) for s in profile.stages)
+        print(kind + ': ' + str(days) + ' days at ' + resolution + ' (' + str(rows) + ' samples), ' +
+              'files generated in {:.1f} s'.format(t_gen))
+        for s in profile.stages:
+            print('    {:<28}{:>8.3f} s'.format(s['stage'], s['wall time (s)']))
+        print('    {:<28}{:>8.3f} s'.format('total', sum(s['wall time (s)'] for s in profile.stages)))
+
+
+def read_and_process(config, profile=None):
+
+    """
+
+    Reads survey and runs its pre-processing modules as pipeline.run(), without summary tables or export
+
+    """
+
+    import profiling
+    import outputs_ui
+    from read_data import read
+
+    user_metadata = [config["frequency weighting"]] + config["percentiles"]
+
+    with profiling.stage(profile, 'read') as record:
+        data, metadata = read(config["type"], config["input"], user_metadata)
+        if config.get("compact"):
+            data = process.to_compact(data)
+        profiling.set_output(record, data)
+
+    prune = None
+    if config.get("prune columns"):
+        prune = outputs_ui.unused_spectra(data, metadata["Frequency Weighting"])
+
+    return process.process_batch(
+        data, config["modules"], metadata, profile=profile, compact=config.get("compact"), prune=prune
+    )[0]
+
+
+def golden(mode=None):
+
+    """
+
+    Processes small synthetic survey of each kind and checks processed data and summary tables against golden
+    outputs in GOLDEN_FILE. Returns 1 if any survey doesn't match, 0 otherwise
+
+    :param mode         : 'update' to rewrite golden outputs after an intended change in results, or 'compact' to
+                          check processing in compact mode (config "compact") against the same outputs
+
+    """
+
+    import pipeline
+    import columnar
+
+    results = {}
+
+    for kind in SURVEYS:
+        with TemporaryDirectory() as folder:
+
+            config = survey(kind, folder, GOLDEN_DAYS, GOLDEN_RESOLUTION)
+            config['columnar output'] = True
+            config['compact'] = mode == 'compact'
+
+            with redirect_stdout(StringIO()):
+                if kind in TABLES_UNSUPPORTED:
+                    data, tables = read_and_process(config), []
+                else:
+                    pipeline.run(config)
+                    data, _, tables = columnar.load(config['output'][0] + '_data')
+
+            results[kind] = golden_summary(data, tables)
+
+    if mode == 'update':
+        with open(GOLDEN_FILE, 'w') as file:
+            json.dump(results, file, indent=1)
+        print("Golden outputs written: " + GOLDEN_FILE)
+        return 0
+
+    with open(GOLDEN_FILE, 'r') as file:
+        expected = json.load(file)
+
+    failed = 0
+    for kind, result in results.items():
+
+        # Duration isn't stored in compact mode
+        if mode == 'compact':
+            expected[kind]['columns'].pop('Duration', None)
+
+        diffs = golden_diff(result, expected.get(kind), kind)
+        print('{:<12}{}'.format(kind, 'OK' if not diffs else 'MISMATCH'))
+        for d in diffs[:10]:
+            print('    ' + d)
+        failed += bool(diffs)
+
+    return 1 if failed else 0
+
+
+def golden_summary(data, tables):
+
+    """
+
+    Returns JSON-serialisable summary of processed data (count and sum of each column) and summary tables (all
+    values) for golden()
+
+    """
+
+    columns = {}
+    for c in data.columns:
+        col = data[c]
+        if col.dtype.kind == 'm':
+            columns[c] = [int(col.notna().sum()), col.dt.total_seconds().sum()]
+        elif col.dtype.kind in 'biuf':
+            columns[c] = [int(col.notna().sum()), float(col.astype(float).sum())]
+        else:
+            columns[c] = [int(col.notna().sum())]
+
+    return {
+        'index': [str(data.index[0]), str(data.index[-1]), len(data)],
+        'columns': columns,
+        'tables': [
+            {
+                'index': [str(i) for i in t.index],
+                'columns': [str(c) for c in t.columns],
+                'values': [[golden_value(v) for v in row] for row in t.values]
+            }
+            for t in tables
+        ]
+    }
+
+
+def golden_value(value):
+
+    if isinstance(value, (int, float, number)) and not isinstance(value, bool):
+        return None if value != value else float(value)
+
+    return str(value)
+
+
+def golden_diff(result, expected, name, tolerance=1e-3):
+
+    """
+
+    Returns list of differences between result and expected golden summary (numbers compared to within tolerance,
+    plus a relative tolerance of 1e-6 for sums)
+
+    """
+
+    if isinstance(expected, dict) and isinstance(result, dict):
+        if result.keys() != expected.keys():
+            return [name + ': keys ' + str(sorted(set(result) ^ set(expected)))]
+        return [d for k in expected for d in golden_diff(result[k], expected[k], name + '/' + str(k), tolerance)]
+
+    if isinstance(expected, list) and isinstance(result, list):
+        if len(result) != len(expected):
+            return [name + ': length {} (expected {})'.format(len(result), len(expected))]
+        return [d for i, (r, e) in enumerate(zip(result, expected))
+                for d in golden_diff(r, e, name + '/' + str(i), tolerance)]
+
+    if isinstance(expected, float) and isinstance(result, (int, float)):
+        if (result == expected) or (abs(result - expected) <= tolerance + 1e-6 * abs(expected)):
+            return []
+
+    elif result == expected:
+        return []
+
+    return [name + ': ' + str(result) + ' (expected ' + str(expected) + ')']
+
+
+def chunked(days=2, seed=0):
+
+    """
+
+    Checks custom CSV surveys read in chunks (config "chunk size") against the same modules applied to the whole
+    file, for leading Regularise / Re-sample modules in CHUNKED_MODULES on 1-minute data with jittered times, missing
+    samples, a gap of several hours and duplicated samples. Returns 1 if any output doesn't match, 0 otherwise
+
+    """
+
+    from read_data import read
+
+    rng = random.RandomState(seed)
+    data = synthetic_data(days, '1T', spectral=False, seed=seed, percentiles=PERCENTILES)
+
+    # Jitter times by up to 10 s, then remove random samples and a gap, and duplicate random samples
+    data.index = data.index + to_timedelta(rng.randint(-10, 11, len(data)), unit='s')
+    keep = rng.rand(len(data)) > 0.05
+    keep[len(data) // 3:len(data) // 3 + 200] = False
+    data = data[keep]
+    data = data.iloc[sorted(list(range(len(data))) + list(flatnonzero(rng.rand(len(data)) < 0.03)))]
+
+    columns = {'Time': 'Timestamp', 'LAeq_Main': 'LAeq', 'LAmax_Main': 'LAmax', 'LAmin_Main': 'LAmin'}
+    for p in PERCENTILES:
+        columns['LA' + str(p).zfill(2) + '_Main'] = 'LA' + str(p).zfill(2)
+    time_format = '%d/%m/%Y %H:%M:%S'
+    user_metadata = ['A'] + list(PERCENTILES)
+
+    failed = 0
+
+    with TemporaryDirectory() as folder:
+
+        file_in = path.join(folder, 'chunked.csv')
+        write_csv(data, file_in, columns, time_format)
+
+        for modules in CHUNKED_MODULES:
+
+            with redirect_stdout(StringIO()):
+                data_ref, metadata = read('custom_csv', [file_in], user_metadata, columns=columns,
+                                          time_format=time_format)
+                data_ref = process.process_batch(data_ref, modules, metadata)[0]
+
+            for chunksize in CHUNK_SIZES:
+
+                data_out = read('custom_csv', [file_in], user_metadata, columns=columns, time_format=time_format,
+                                chunksize=chunksize, modules=modules)[0]
+
+                diffs = chunked_diff(data_out, data_ref)
+                print('{:<56}{}'.format(
+                    (', '.join(m[0] + ' ' + str(m[1][0]) for m in modules) or 'No modules') + ' / ' + str(chunksize) +
+                    ' rows',
+                    'OK' if not diffs else 'MISMATCH'
+                ))
+                for d in diffs:
+                    print('    ' + d)
+                failed += bool(diffs)
+
+    return 1 if failed else 0
+
+
+def chunked_diff(data_out, data_ref, tolerance=1e-3):
+
+    """
+
+    Returns list of differences between data read in chunks and reference data (numbers to within tolerance, as
+    levels are read as float32)
+
+    """
+
+    if not data_out.index.equals(data_ref.index):
+        return ['index: {} rows from {} to {} (expected {} from {} to {})'.format(
+            len(data_out), data_out.index[0], data_out.index[-1], len(data_ref), data_ref.index[0], data_ref.index[-1]
+        )]
+
+    diffs = []
+    if data_out.index.freq != data_ref.index.freq:
+        diffs.append('index frequency: {} (expected {})'.format(data_out.index.freq, data_ref.index.freq))
+    if list(data_out.columns) != list(data_ref.columns):
+        diffs.append('columns: ' + str(sorted(set(data_out.columns) ^ set(data_ref.columns))))
+
+    for c in data_ref.columns.intersection(data_out.columns):
+        values_out, values_ref = chunked_values(data_out[c]), chunked_values(data_ref[c])
+        bad = ~isclose(values_out, values_ref, rtol=0, atol=tolerance, equal_nan=True)
+        if bad.any():
+            diffs.append('{}: {} values differ, first at {}'.format(c, bad.sum(), data_ref.index[bad][0]))
+
+    return diffs
+
+
+
+def chunked_values(col):
+
+    return col.dt.total_seconds().values if col.dtype.kind == 'm' else col.values.astype(float)
+
+
+def startup(top=10):
+
+    """
+
+    Prints time to import GUI module (at startup) and pipeline (in background / on first use of "Process data"),
+    each in a fresh interpreter, with time spent in each of the slowest packages from python -X importtime
+
+    """
+
+    for module in ['NoiseDataProcessor_ui', 'pipeline']:
+
+        t0 = perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+            cwd=path.dirname(path.abspath(__file__))
+        )
+        t_total = perf_counter() - t0
+
+        if result.returncode != 0:
+            print("Import " + module + " failed:\n" + result.stderr.strip().splitlines()[-1])
+            continue
+
+        total, packages = import_times(result.stderr, module)
+
+        print("Import " + module + ": {:.3f} s ({:.3f} s including interpreter start)".format(total, t_total))
+        for name, t in sorted(packages.items(), key=lambda x: -x[1])[:top]:
+            print('    {:<24}{:.3f} s'.format(name, t))
+
+
+def import_times(log, module):
+
+    """
+
+    Returns (time to import module, {top-level package: time}) in s from python -X importtime output, where each
+    package's time is the sum of its modules' own (self) import times
+
+    """
+
+    total, packages = 0, {}
+
+    for line in log.splitlines():
+
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            continue
+
+        package = name.strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(self_us) / 1e6
+
+        if name.strip() == module:
+            total = int(cumulative_us) / 1e6
+
+    return total, packages
+
+
+def resample_noise_merge(data, args):
+
+    """
+
+    Previous implementation of process.resample_noise(), building output with one outer merge per aggregation
+    Kept as reference for benchmarking and checking results
+
+    """
+
+    res_out, max_remove, avg_type, f_weight, percentiles, leq_avg = args
+
+    if type(res_out) == int:
+        res_out = str(res_out) + 'T'
+
+    cols = data.columns
+    resamp_idx = date_range(data.index.min().floor(res_out), data.index.max(), freq=res_out, name='Time')
+    codes = process.bin_codes(data.index, resamp_idx)
+    data_out = DataFrame()
+
+    # Count missing samples
+    freq_in, freq_out = data.index.freq, resamp_idx.freq
+
+    if freq_in == BusinessHour():
+        freq_in = Hour()
+    if freq_out == BusinessHour():
+        freq_out = Hour()
+
+    n = freq_out / freq_in
+
+    if n >= 1:
+        data_tmp = DataFrame(index=data.index)
+        data_tmp['Missing Samples'] = 1
+        data_tmp = n - data_tmp.filter(regex='Missing Samples').resample(res_out).sum().reindex(resamp_idx)
+        data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
+    else:
+        data_out['Missing Samples'] = 0
+
+    # Leq dependant on input arguments
+
+    # Log average for Leq (if used as pre-processing module)
+    if leq_avg == 'log':
+
+        data_tmp = 10**(data.filter(regex='^L' + f_weight + 'eq')/10)
+
+        if len(data_tmp.columns) > 0:
+            data_tmp = data_tmp.resample(res_out).mean().reindex(resamp_idx)
+            data_tmp = 10 * log10(data_tmp)
+            data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
+
+    # Linear average for Leq (if used for summary table generation)
+    elif leq_avg == 'linear':
+
+        data_tmp = data.filter(regex='^L' + f_weight + 'eq')
+
+        if len(data_tmp.columns) > 0:
+            data_tmp = data_tmp.resample(res_out).mean().reindex(resamp_idx)
+            data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
+
+    # Minimum for Lmin / Start Time
+    cols_tmp = data.filter(regex='^L' + f_weight + 'min').columns.to_list()
+    data_tmp = data[cols_tmp].resample(res_out).min().reindex(resamp_idx)
+
+    if len(data_tmp.columns) > 0:
+        data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
+
+    # Maximum for Lmax (after excluding highest max_remove entries in each re-sampled period)
+    data_tmp = data.filter(regex='^L' + f_weight + 'max')
+
+    if len(data_tmp.columns) > 0:
+        data_tmp = DataFrame(
+            process.nth_largest(data_tmp.values.astype(float), codes, len(resamp_idx), max_remove),
+            index=resamp_idx,
+            columns=data_tmp.columns
+        )
+        data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
+
+    # Percentiles
+    #  - Perhaps output histograms to inform choices
+    for p in percentiles:
+
+        data_tmp = data.filter(regex='^L' + f_weight + str(p).zfill(2))
+
+        if len(data_tmp.columns) > 0:
+
+            if avg_type == 'mean':
+                data_tmp = data_tmp.resample(res_out).mean().reindex(resamp_idx)
+            else:
+                data_tmp = DataFrame(
+                    process.grouped_stats(data_tmp.values.astype(float), codes, len(resamp_idx), [avg_type])[avg_type],
+                    index=resamp_idx,
+                    columns=data_tmp.columns
+                )
+
+            data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
+
+    # Log sum for LE
+    data_tmp = 10**(data.filter(regex='^L' + f_weight + 'E')/10)
+
+    if len(data_tmp.columns) > 0:
+        data_tmp = data_tmp.resample(res_out).sum().reindex(resamp_idx)
+        data_tmp = 10 * log10(data_tmp)
+        data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
+
+    # Last for End Time
+    if 'End_Time' in data.columns:
+        data_tmp = data[['End_Time']].resample(res_out).last().reindex(resamp_idx)
+        data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
+
+    # First for everything else
+    remainder = []
+    for c in cols:
+        if c not in data_out.columns:
+            remainder.append(c)
+
+    data_tmp = data[remainder].resample(res_out).first().reindex(resamp_idx)
+
+    if len(data_tmp.columns) > 0:
+        data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
+
+    data_out['Duration'] = to_timedelta(res_out)
+    # What are columns [*, Over, Under, Pause] and how do we deal with them?
+
+    return data_out[cols], 'No auxiliary data'
+
+
+if __name__ == "__main__":
+
+    benchmarks = {
+        'resample': resample,
+        'startup': startup,
+        'pipeline': pipeline_stages,
+        'golden': golden,
+        'chunked': chunked,
+    }
+
+    # Output template is found relative to working directory
+    chdir(path.dirname(path.abspath(__file__)))
+
+    name = sys.argv[1] if len(sys.argv) > 1 else 'resample'
+    bench_args = [int(a) if a.isdigit() else a for a in sys.argv[2:]]
+    sys.exit(benchmarks[name](*bench_args))
@@ -0,0 +1,206 @@
+# Persistent cache of standard format DataFrames returned by read_data.read()
+#   - Keyed on input file fingerprints (path, size, modification time, content hash) and user metadata
+#   - Stored as pickles of (data, metadata), evicted least recently used first when over size limit
+
+from os import path, makedirs, listdir, remove, replace, stat, utime, getpid, open as os_open, close, \
+    O_CREAT, O_EXCL, O_WRONLY
+from contextlib import contextmanager
+from time import time, sleep
+from hashlib import blake2b
+from json import dumps, load, dump
+from pickle import dump as dump_pickle, load as load_pickle, HIGHEST_PROTOCOL, UnpicklingError
+from pandas import __version__ as pandas_version
+import read_data
+
+INDEX_FILE = 'fingerprints.json'
+
+
+def read(file_type, files, user_metadata, workers=1, cache_dir='cache', max_size=1024, progress=None, **kwargs):
+
+    """
+
+    Returns (data, metadata) as read_data.read(), loading from cache if input files are unchanged
+
+    :param cache_dir    : Directory in which to store cached DataFrames
+    :param max_size     : Maximum total size of cache directory (MB)
+
+    All other arguments as read_data.read()
+
+    """
+
+    makedirs(cache_dir, exist_ok=True)
+
+    key = cache_key(file_type, files, user_metadata, cache_dir, **kwargs)
+    file_cache = path.join(cache_dir, key + '.pkl')
+
+    if path.isfile(file_cache):
+        try:
+            with open(file_cache, 'rb') as file:
+                data, metadata = load_pickle(file)
+
+            # Mark as recently used
+            utime(file_cache)
+            print("Data loaded from cache: " + file_cache)
+
+            return data, metadata
+
+        except (EOFError, UnpicklingError):
+            remove(file_cache)
+
+    data, metadata = read_data.read(file_type, files, user_metadata, workers, progress, **kwargs)
+
+    # Write to temporary file first so an interrupted write can't leave a corrupt entry
+    with open(file_cache + '.tmp', 'wb') as file:
+        dump_pickle((data, metadata), file, protocol=HIGHEST_PROTOCOL)
+    replace(file_cache + '.tmp', file_cache)
+
+    evict(cache_dir, max_size, keep=file_cache)
+
+    return data, metadata
+
+
+def cache_key(file_type, files, user_metadata, cache_dir, **kwargs):
+
+    """
+
+    Returns hex digest identifying input files (by fingerprint) and the settings used to read them
+    (file type, user metadata and read_data.read() keyword arguments)
+
+    """
+
+    key = {
+        'type': file_type,
+        'files': fingerprints(read_data.data_files(file_type, files), cache_dir),
+        'metadata': user_metadata,
+        'options': kwargs,
+        'pandas': pandas_version
+    }
+
+    return blake2b(dumps(key, default=str).encode(), digest_size=16).hexdigest()
+
+
+def fingerprints(files, cache_dir):
+
+    """
+
+    Returns list of [path, size, mtime, content hash] for each file
+
+    Content hashes are stored in the cache directory and only recalculated if a file's size or mtime changes
+
+    """
+
+    file_index = path.join(cache_dir, INDEX_FILE)
+    index = load_index(file_index)
+
+    changed = {}
+    out = []
+    for f in files:
+
+        f = path.abspath(f)
+        f_stat = stat(f)
+        size, mtime = f_stat.st_size, f_stat.st_mtime_ns
+
+        if (f in index) and (index[f][:2] == [size, mtime]):
+            content_hash = index[f][2]
+        else:
+            content_hash = file_hash(f)
+            changed[f] = [size, mtime, content_hash]
+
+        out.append([f, size, mtime, content_hash])
+
+    # Index may be shared with other processes (e.g. batch workers), so merge with its latest entries while holding
+    # its lock, and write to a temporary file of this process first, so readers never see a partially written index
+    if changed:
+        with index_lock(file_index):
+            index = load_index(file_index)
+            index.update(changed)
+            file_tmp = file_index + '.' + str(getpid()) + '.tmp'
+            with open(file_tmp, 'w') as file:
+                dump(index, file)
+            replace(file_tmp, file_index)
+
+    return out
+
+
+def load_index(file_index):
+
+    """
+
+    Returns dict of stored file fingerprints, empty if index doesn't exist or can't be read
+
+    """
+
+    try:
+        with open(file_index, 'r') as file:
+            index = load(file)
+    except (OSError, ValueError):
+        return {}
+
+    return index if isinstance(index, dict) else {}
+
+
+@contextmanager
+def index_lock(file_index, timeout=10):
+
+    """
+
+    Holds lock file beside index while updating it. A lock held for longer than timeout (s) is taken to be left by
+    a process that was killed, and is removed
+
+    """
+
+    file_lock = file_index + '.lock'
+    t = time()
+
+    while True:
+        try:
+            close(os_open(file_lock, O_CREAT | O_EXCL | O_WRONLY))
+            break
+        except FileExistsError:
+            if time() - t > timeout:
+                try:
+                    remove(file_lock)
+                except FileNotFoundError:
+                    pass
+                t = time()
+            sleep(0.01)
+
+    try:
+        yield
+    finally:
+        remove(file_lock)
+
+
+def file_hash(file_in, chunk_size=2**20):
+
+    h = blake2b(digest_size=16)
+    with open(file_in, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def evict(cache_dir, max_size, keep=None):
+
+    """
+
+    Removes least recently used entries until cache directory is within max_size (MB)
+    Entry given by keep (i.e. the one just written) is never removed
+
+    """
+
+    entries = []
+    for f in listdir(cache_dir):
+        if f.endswith('.pkl'):
+            f_stat = stat(path.join(cache_dir, f))
+            entries.append((f_stat.st_mtime, f_stat.st_size, path.join(cache_dir, f)))
+
+    total = sum(e[1] for e in entries)
+
+    for _, size, f in sorted(entries):
+        if total <= max_size * 2**20:
+            break
+        if f != keep:
+            remove(f)
+            total -= size
@@ -0,0 +1,122 @@
+# Columnar (Parquet) output of processed survey data, alongside the Excel report
+#   - Processed data, metadata and daily_table() summary tables written to compressed Parquet files in one folder
+#   - Index, dtypes and sample resolution preserved on reloading with load(), which is much faster than reading
+#     the Full_Data sheet back from Excel and isn't limited to Excel's maximum number of rows
+#   - Requires pyarrow
+
+from os import path, makedirs
+from json import dump, load as load_json, loads
+from pandas import read_parquet, DataFrame, Index, Series, Timestamp, to_timedelta
+from numpy import isnat, unique, full, array
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def export(data, metadata, tables, config):
+
+    """
+
+    Writes processed data, metadata and summary tables to folder named after output file, e.g. 'Survey_data' for
+    output 'Survey' (call before outputs_ui.export_excel(), which modifies tables)
+
+    :param data         : Processed DataFrame
+    :param metadata     : Metadata Series returned by read_data.read()
+    :param tables       : List of tables returned by outputs_ui.daily_table()
+    :param config       : Config dict, used for output file name
+
+    :return             : Output folder
+
+    """
+
+    folder_out = config["output"][0] + "_data"
+    makedirs(folder_out, exist_ok=True)
+
+    # Parquet can't store timedeltas, so store as integer nanoseconds; object columns (e.g. flags of start time or
+    # None) are read back as typed columns, so are converted back on loading
+    timedelta_cols = data.columns[[d.kind == 'm' for d in data.dtypes]].to_list()
+    object_cols = data.columns[[d.kind == 'O' for d in data.dtypes]].to_list()
+
+    data_out = data.copy()
+    for c in timedelta_cols:
+        data_out[c] = data_out[c].values.view('int64')
+
+    data_out.to_parquet(path.join(folder_out, 'data.parquet'))
+
+    # Tables without columns (e.g. "No spectral data available") are stored by index name only
+    table_files = []
+    for i, t in enumerate(tables):
+        if len(t.columns) == 0:
+            table_files.append({'index name': t.index.name})
+        else:
+            table_files.append('table_' + str(i).zfill(2) + '.parquet')
+            t.to_parquet(path.join(folder_out, table_files[-1]))
+
+    manifest = {
+        'freq': data.index.freqstr,
+        'timedelta columns': timedelta_cols,
+        'object columns': object_cols,
+        'metadata': loads(metadata.to_json(orient='split')),
+        'tables': table_files
+    }
+
+    with open(path.join(folder_out, MANIFEST_FILE), 'w') as file:
+        dump(manifest, file, indent=4)
+
+    return folder_out
+
+
+def load(folder_in):
+
+    """
+
+    Returns (data, metadata, tables) as written by export()
+
+    """
+
+    with open(path.join(folder_in, MANIFEST_FILE), 'r') as file:
+        manifest = load_json(file)
+
+    data = read_parquet(path.join(folder_in, 'data.parquet'))
+
+    for c in manifest['timedelta columns']:
+        data[c] = to_timedelta(data[c].values, unit='ns')
+
+    for c in manifest['object columns']:
+        if data[c].dtype.kind == 'M':
+            data[c] = Series(object_datetimes(data[c].values), index=data.index, dtype=object)
+        elif data[c].dtype.kind != 'O':
+            data[c] = data[c].astype(object).where(data[c].notna(), None)
+
+    if manifest['freq'] is not None:
+        data.index.freq = manifest['freq']
+
+    metadata = Series(
+        manifest['metadata']['data'], index=manifest['metadata']['index'], name=manifest['metadata']['name']
+    )
+
+    tables = []
+    for t in manifest['tables']:
+        if type(t) == dict:
+            tables.append(DataFrame(index=Index([], name=t['index name'])))
+        else:
+            tables.append(read_parquet(path.join(folder_in, t)))
+
+    return data, metadata, tables
+
+
+def object_datetimes(values):
+
+    """
+
+    Returns object array of Timestamps (None for NaT) from datetime64 array, converting each distinct value once
+    (e.g. flag columns, which hold only their period's start time)
+
+    """
+
+    valid = ~isnat(values)
+    unique_values, codes = unique(values[valid], return_inverse=True)
+
+    out = full(len(values), None, dtype=object)
+    out[valid] = array([Timestamp(v) for v in unique_values], dtype=object)[codes]
+
+    return out
@@ -9,7 +9,7 @@ def nl52(metadata, metadata_file):
     file_path, file_base = path.split(metadata_file)
 
     files = []
-    for f in Path(file_path + '\\AUTO_LEQ').rglob('*' + metadata.loc['Store Name'][1] + '*.rnd'):
+    for f in Path(path.join(file_path, 'AUTO_LEQ')).rglob('*' + metadata['Store Name'] + '*.rnd'):
         files.append(f)
 
     return files
@@ -0,0 +1,269 @@
+# Incremental processing for ongoing long-term monitoring deployments
+#   - Keeps aggregated state for each time period and day in a state file: Leq energy sums and sample counts,
+#     first / last sample times, highest Lmax values and histograms of L10 / L90 values
+#   - Each run reads only data files not yet processed, adds them to the days they touch, then generates the
+#     daily_table() summary tables from the stored state rather than from the full history
+
+from os import path, stat, replace
+from pickle import dump, load, HIGHEST_PROTOCOL
+from numpy import log10, round_, repeat, floor, ceil, array, nan
+from pandas import DataFrame, Series, DatetimeIndex, to_timedelta
+import read_data
+import outputs_ui
+import schema
+from process import float_values
+
+
+def new_files(state_file, file_type, files):
+
+    """
+
+    Returns (new, processed):
+        - new       : list of data files not yet included in state file
+        - processed : sorted list of absolute paths of data files already included, for read_data.read(skip=...)
+
+    Raises exception if an already processed file has changed since, as its old contribution can't be removed
+
+    """
+
+    state = load_state(state_file)
+
+    data_files = read_data.data_files(file_type, files)
+    if file_type in ['nl32_metadata', 'nl52_metadata']:
+        data_files = data_files[1:]
+
+    new, processed = [], set()
+    for f in data_files:
+
+        f = path.abspath(f)
+
+        if f not in state['files']:
+            new.append(f)
+        elif state['files'][f] != fingerprint(f):
+            raise Exception(
+                "Data file " + f + " has changed since it was processed. Delete " + state_file +
+                " to rebuild from all data"
+            )
+        else:
+            processed.add(f)
+
+    return new, sorted(processed)
+
+
+def update(state_file, data, files, f_weight, max_remove):
+
+    """
+
+    Adds processed data from new files to state file, then returns summary tables for all data in it
+
+    :param data         : Processed DataFrame from new files only (i.e. output of process.process_batch())
+    :param files        : New data files included in data, as returned by new_files()
+    :param f_weight     : Frequency weighting, e.g. 'A'
+    :param max_remove   : Number of highest Lmax values to ignore in each period-day
+
+    :return             : Tables as outputs_ui.daily_table(), without Lmax spectra (which need the full data)
+
+    """
+
+    state = load_state(state_file)
+
+    if state['f_weight'] is None:
+        state['f_weight'], state['max_remove'], state['freq'] = f_weight, max_remove, data.index.freq
+    elif (state['f_weight'], state['max_remove']) != (f_weight, max_remove):
+        raise Exception(
+            "Frequency weighting and Lmax summary remove must match those used to create " + state_file
+        )
+
+    accumulate(state, data)
+
+    for f in files:
+        state['files'][path.abspath(f)] = fingerprint(f)
+
+    # Write to temporary file first so an interrupted write can't leave a corrupt state
+    with open(state_file + '.tmp', 'wb') as file:
+        dump(state, file, protocol=HIGHEST_PROTOCOL)
+    replace(state_file + '.tmp', state_file)
+
+    return tables(state)
+
+
+def load_state(state_file):
+
+    if path.isfile(state_file):
+        with open(state_file, 'rb') as file:
+            return load(file)
+
+    return {
+        'files': {},        # Absolute path: [size, mtime] of each data file included
+        'days': {},         # (Period, start of period-day): aggregated values, see accumulate()
+        'starts': {},       # Period: start time of period within day (timedelta)
+        'metrics': [],      # Non-spectral metrics in data, e.g. ['LAeq_Main', 'LAmax_Main']
+        'leq_spectra': [],
+        'f_weight': None,
+        'max_remove': None,
+        'freq': None
+    }
+
+
+def fingerprint(file_in):
+
+    f_stat = stat(file_in)
+
+    return [f_stat.st_size, f_stat.st_mtime_ns]
+
+
+def accumulate(state, data):
+
+    """
+
+    Adds each sample in data to the stored values of its time period and day (shifted by period start time as in
+    outputs_ui.daily_table()). All stored values can be combined exactly with later samples:
+        - start, end    : first and last sample times
+        - energy, count : sum of 10^(Leq/10) and number of Leq samples, for Leq and each Leq spectral column
+        - lmax          : (max_remove + 1) highest Lmax values, in descending order
+        - hist          : for L10 and L90, dict of {value: number of samples}
+
+    """
+
+    f_weight, max_remove = state['f_weight'], state['max_remove']
+
+    leq = 'L' + f_weight + 'eq_Main'
+    lmax = 'L' + f_weight + 'max_Main'
+    l10 = 'L' + f_weight + '10_Main'
+    l90 = 'L' + f_weight + '90_Main'
+
+    for m in [leq, lmax, l10, l90]:
+        if (m in data.columns) and (m not in state['metrics']):
+            state['metrics'].append(m)
+
+    for c in schema.of(data).metric('L' + f_weight + 'eq', 'band'):
+        if c not in state['leq_spectra']:
+            state['leq_spectra'].append(c)
+
+    leq_cols = [c for c in [leq] + state['leq_spectra'] if c in data.columns]
+
+    # Widen compact (float32) levels, so stored state is the same as from full precision data
+    compact = data.columns[[d == 'float32' for d in data.dtypes]]
+    if len(compact) > 0:
+        data = data.assign(**dict(zip(compact, float_values(data[compact]).T)))
+
+    # Get time periods created with process.flag_periods(), or whole days if none
+    flags = schema.of(data).flags()
+    if not flags:
+        data = data.assign(Flag_24hr_Day=data.index.min().floor('1D'))
+        flags = ['Flag_24hr_Day']
+
+    for f in flags:
+
+        df = data.dropna(subset=[f])
+
+        if df.empty:
+            continue
+
+        period = f.replace('Flag_', '')
+        t_start = to_timedelta(df[f].iloc[0].time().strftime('%H:%M:%S'))
+        state['starts'][period] = t_start
+
+        # Shift data by period's start time to account for overnight cases
+        days = (df.index - t_start).floor('1D')
+
+        times = Series(df.index, index=df.index).groupby(days).agg(['min', 'max'])
+        energy = (10 ** (df[leq_cols] / 10)).groupby(days).sum()
+        count = df[leq_cols].groupby(days).count()
+
+        for day in times.index:
+
+            rec = state['days'].setdefault((period, day), {
+                'start': times.loc[day, 'min'],
+                'end': times.loc[day, 'max'],
+                'energy': Series(),
+                'count': Series(),
+                'lmax': [],
+                'hist': {l10: {}, l90: {}}
+            })
+
+            rec['start'] = min(rec['start'], times.loc[day, 'min'])
+            rec['end'] = max(rec['end'], times.loc[day, 'max'])
+            rec['energy'] = rec['energy'].add(energy.loc[day], fill_value=0)
+            rec['count'] = rec['count'].add(count.loc[day], fill_value=0)
+
+        if lmax in df.columns:
+            top = df[lmax].groupby(days).apply(lambda x: x.nlargest(max_remove + 1).to_list())
+            for day, values in top.items():
+                rec = state['days'][(period, day)]
+                rec['lmax'] = sorted(rec['lmax'] + values, reverse=True)[:max_remove + 1]
+
+        for p in [l10, l90]:
+            if p in df.columns:
+                for (day, value), n in df[p].groupby([days, df[p]]).size().items():
+                    hist = state['days'][(period, day)]['hist'][p]
+                    hist[value] = hist.get(value, 0) + n
+
+
+def tables(state):
+
+    """
+
+    Returns summary tables from stored state, via outputs_ui.summary_tables()
+
+    """
+
+    f_weight = state['f_weight']
+    lmax = 'L' + f_weight + 'max_Main'
+
+    rows, idx = [], []
+    for (period, day), rec in state['days'].items():
+
+        row = {'Period': period, 'Start_Time': rec['start'], 'End_Time': rec['end']}
+
+        # Log average for Leq
+        for c in rec['energy'].index:
+            row[c] = 10 * log10(rec['energy'][c] / rec['count'][c]) if rec['count'][c] > 0 else nan
+
+        # Maximum after excluding highest max_remove values (lowest value if fewer samples)
+        if lmax in state['metrics']:
+            row[lmax] = rec['lmax'][-1] if rec['lmax'] else nan
+
+        # Mean, mode and lower quartile for L10 / L90
+        for p, hist in rec['hist'].items():
+            if p in state['metrics']:
+                row[p + '_mean'], row[p + '_mode'], row[p + '_lq'] = hist_stats(hist)
+
+        rows.append(row)
+        idx.append(day + state['starts'][period])
+
+    df_out = DataFrame(rows, index=DatetimeIndex(idx))
+    flags = ['Flag_' + p for p in state['starts']]
+
+    return outputs_ui.summary_tables(
+        df_out, flags, f_weight, state['metrics'], state['leq_spectra'], state['freq']
+    )
+
+
+def hist_stats(hist):
+
+    """
+
+    Returns (mean, mode, lower quartile) of values in histogram {value: count}, as process.grouped_stats()
+
+    """
+
+    if not hist:
+        return nan, nan, nan
+
+    values = array(sorted(hist))
+    counts = array([hist[v] for v in values])
+
+    mean = (values * counts).sum() / counts.sum()
+
+    # Lowest mode after rounding to nearest integer
+    modes = Series(counts, index=round_(values)).groupby(level=0).sum()
+    mode = modes.index[modes.values.argmax()]
+
+    # Lower quartile by linear interpolation
+    values = repeat(values, counts)
+    pos = 0.25 * (len(values) - 1)
+    lo, hi = values[int(floor(pos))], values[int(ceil(pos))]
+    lq = lo + (pos - floor(pos)) * (hi - lo)
+
+    return mean, mode, lq
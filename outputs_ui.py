@@ -1,11 +1,25 @@
 import sys
 
-from pandas import DataFrame, Index, concat, to_datetime, to_timedelta, DatetimeIndex, ExcelWriter, Series
+from pandas import DataFrame, Index, concat, to_datetime, to_timedelta, DatetimeIndex, ExcelWriter, Series, \
+    Timestamp, Timedelta
+from pandas.tseries.offsets import Tick
 from pandas.io.formats.excel import ExcelFormatter
-from process import resample_noise
+from process import resample_periods, grouped_reduce, float_values
+import schema
 from openpyxl import load_workbook
-from datetime import datetime
+from openpyxl.utils import get_column_letter
+from datetime import datetime, timedelta
 from itertools import repeat
+from numpy import round_, isnan, isinf, flatnonzero, arange, cumsum, nansum, full, nan, argsort, concatenate, where, \
+    zeros, bool_, number, array
+from zipfile import ZipFile, ZIP_DEFLATED
+from xml.sax.saxutils import escape, unescape
+from os import replace, remove
+from time import time
+import re
+
+NS_DAY = 86400 * 10**9
+EXCEL_EPOCH = Timestamp('1899-12-30').value
 
 
 def daily_table(data, f_weight, max_remove, lmax_override=None):
@@ -34,87 +48,77 @@ def daily_table(data, f_weight, max_remove, lmax_override=None):
 
     """
 
+    columns = schema.of(data)
+
     # Get list of time periods created with process.flag_periods()
-    flags = data.filter(regex='^Flag_').columns.to_list()
+    flags = columns.flags()
 
     # Extract relevant columns from data
     leq = 'L' + f_weight + 'eq_Main'
     lmax = 'L' + f_weight + 'max_Main'
     l10 = 'L' + f_weight + '10_Main'
     l90 = 'L' + f_weight + '90_Main'
-    leq_spectra = data.filter(regex='L' + f_weight + 'eq_.*Hz').columns.to_list()
+    leq_spectra = columns.metric('L' + f_weight + 'eq', 'band')
 
     main_metrics = []
     for m in [leq, lmax, l10, l90]:
         if m in data.columns:
             main_metrics.append(m)
 
-    df = data[main_metrics + leq_spectra + flags].copy()
-
-    df_out = DataFrame()
+    df = data[main_metrics + leq_spectra + flags]
 
     if not flags:
-        df['Flag_24hr_Day'] = datetime.strptime(
+        df = df.assign(Flag_24hr_Day=datetime.strptime(
             df.index.min().floor('1D').strftime('%d/%m/%y %H:%M'), '%d/%m/%y %H:%M'
-        )
+        ))
         flags = ['Flag_24hr_Day']
 
-    flags_copy = flags.copy()
-    for f in flags:
+    # Daily summary of all time periods in one grouped pass (mean, mode and lower quartile for L10/L90)
+    df_out = resample_periods(df, flags, max_remove, f_weight, [10, 90], ['mean', 'mode', 'lq'])
 
-        # Filter data to period
-        df_tmp = df.dropna(subset=[f]).copy()
+    # Drop time periods without data
+    flags = [f for f in flags if f.replace('Flag_', '') in set(df_out['Period'])]
 
-        if df_tmp.empty:
-            flags_copy.remove(f)
+    return summary_tables(df_out, flags, f_weight, main_metrics, leq_spectra, data.index.freq, data, lmax_override)
 
-        else:
 
-            df_tmp['Period'] = f.replace('Flag_', '')
+def unused_spectra(data, f_weight):
 
-            df_tmp['Start_Time'] = df_tmp.index.copy()
-            df_tmp['End_Time'] = df_tmp.index.copy()
+    """
 
-            # Shift data by period's start time to account for overnight cases
-            t_start = to_timedelta(df_tmp[f][0].time().strftime('%H:%M:%S'))
-            df_tmp.index = df_tmp.index - t_start
+    Returns spectral columns not used by summary tables (i.e. bands of metrics other than Leq and Lmax), which are
+    dropped before processing with config "prune columns". Broadband columns are always kept, as the template's
+    pivot table reads them from Full_Data
 
-            # Use process.resample_noise() function to get daily summary
-            df_mean = resample_noise(df_tmp, ['1D', max_remove, 'mean', f_weight, [10, 90], 'log'])[0]
+    """
 
-            if (l10 in df_tmp.columns) and (l90 in df_tmp.columns):
+    columns = schema.of(data)
+    used = ['L' + f_weight + 'eq', 'L' + f_weight + 'max']
 
-                # Repeat to obtain mode and lower quartile for L10/L90 only
-                df_mode = resample_noise(df_tmp[[l10, l90]], ['1D', max_remove, 'mode', f_weight, [10, 90], 'log'])[0]
-                df_lq = resample_noise(df_tmp[[l10, l90]], ['1D', max_remove, 'lq', f_weight, [10, 90], 'log'])[0]
-    
-                # Merge mode and LQ with general (mean) summary
-                df_tmp = df_mean.merge(
-                    df_mode,
-                    left_index=True,
-                    right_index=True,
-                    how='outer',
-                    suffixes=['_mean', '']
-                )
-    
-                df_tmp = df_tmp.merge(
-                    df_lq,
-                    left_index=True,
-                    right_index=True,
-                    how='outer',
-                    suffixes=['_mode', '_lq']
-                )
+    return [c for c in columns.role('band') if columns.columns[c].metric not in used]
 
-            else:
-                df_tmp = df_mean
 
-            # Invert time-shift
-            df_tmp.index = df_tmp.index + t_start
+def summary_tables(df_out, flags, f_weight, metrics, leq_spectra, freq, data=None, lmax_override=None):
 
-            # Combine with previous time periods
-            df_out = concat([df_out, df_tmp])
+    """
 
-    flags = flags_copy
+    Returns the tables listed in daily_table() from its daily summary of each time period
+
+    :param df_out       : Daily summary, one row per period and day, indexed by start of period-day, with columns
+                          Period, Start_Time, End_Time (first / last sample times), Leq, Lmax, L10/L90 suffixed by
+                          _mean, _mode and _lq, and Leq spectra
+    :param flags        : List of time periods with data, e.g. ['Flag_Daytime', 'Flag_Night-time']
+    :param metrics      : Non-spectral metrics present in data, e.g. ['LAeq_Main', 'LAmax_Main']
+    :param leq_spectra  : Leq spectral columns present in data
+    :param freq         : Sample resolution of data, added to End_Time
+    :param data         : Full dataset, used to look up Lmax spectra; if None, Lmax spectral tables are left empty
+
+    """
+
+    leq = 'L' + f_weight + 'eq_Main'
+    lmax = 'L' + f_weight + 'max_Main'
+    l10 = 'L' + f_weight + '10_Main'
+    l90 = 'L' + f_weight + '90_Main'
 
     # Set up aggregation method by column
     cols_out = {
@@ -125,13 +129,13 @@ def daily_table(data, f_weight, max_remove, lmax_override=None):
         leq: 'mean',
     }
 
-    if lmax in df.columns:
+    if lmax in metrics:
         cols_out[lmax] = 'mean'
-    if l10 in df.columns:
+    if l10 in metrics:
         cols_out[l10 + '_mean'] = 'mean'
         cols_out[l10 + '_mode'] = 'mean'
         cols_out[l10 + '_lq'] = 'mean'
-    if l90 in df.columns:
+    if l90 in metrics:
         cols_out[l90 + '_mean'] = 'mean'
         cols_out[l90 + '_mode'] = 'mean'
         cols_out[l90 + '_lq'] = 'mean'
@@ -199,11 +203,9 @@ def daily_table(data, f_weight, max_remove, lmax_override=None):
     main_mode = df_mode[df_main_cols]
 
     # Catch non-spectral data
-    spectral = False
-    for c in data.columns:
-        if 'Hz' in c:
-            spectral = True
-            break
+    spectral = len(leq_spectra) > 0
+    if (data is not None) and schema.of(data).role('band'):
+        spectral = True
 
     if spectral:
 
@@ -212,14 +214,24 @@ def daily_table(data, f_weight, max_remove, lmax_override=None):
         spec_leq_max = df_max[df_spec_cols]
         spec_leq_mode = df_mode[df_spec_cols]
 
-        if lmax in data.columns:
-            spec_lmax_main = lmax_spectra(data, main, f_weight, flags, summary=False)
-            spec_lmax_mean = lmax_spectra(data, main_mean, f_weight, flags, summary=True)
-            spec_lmax_max = lmax_spectra(data, main_max, f_weight, flags, summary=True)
-            spec_lmax_mode = lmax_spectra(data, main_mode, f_weight, flags, summary=True)
+        if data is None:
+            spec_lmax_main = DataFrame(index=Index([], name="Lmax spectra not available"))
+            spec_lmax_mean, spec_lmax_max, spec_lmax_mode, spec_lmax_user = repeat(DataFrame(), 4)
+
+        elif lmax in data.columns:
+
+            # Sort samples for Lmax lookup once, for all tables
+            lookup = lmax_lookup(data, f_weight, flags)
+
+            spec_lmax_main = lmax_spectra(data, main, f_weight, flags, summary=False, lookup=lookup)
+            spec_lmax_mean = lmax_spectra(data, main_mean, f_weight, flags, summary=True, lookup=lookup)
+            spec_lmax_max = lmax_spectra(data, main_max, f_weight, flags, summary=True, lookup=lookup)
+            spec_lmax_mode = lmax_spectra(data, main_mode, f_weight, flags, summary=True, lookup=lookup)
 
             if lmax_override:
-                spec_lmax_user = lmax_spectra(data, main_mean, f_weight, flags, summary=True, lmax_override=lmax_override)
+                spec_lmax_user = lmax_spectra(
+                    data, main_mean, f_weight, flags, summary=True, lmax_override=lmax_override, lookup=lookup
+                )
                 spec_lmax_user['Day'] = 'User-defined Lmax (full survey)'
             else:
                 spec_lmax_user = DataFrame(index=Index([], name="No user-defined Lmax"))
@@ -248,7 +260,7 @@ def daily_table(data, f_weight, max_remove, lmax_override=None):
     for i, t in enumerate(tables):
         if 'End_Time' in t.columns:
 
-            end_time = (to_datetime(t.loc[:, 'End_Time']) + data.index.freq).apply(lambda x: x.strftime('%H:%M'))
+            end_time = (to_datetime(t.loc[:, 'End_Time']) + freq).apply(lambda x: x.strftime('%H:%M'))
             t = t.drop(columns='End_Time')
             t.insert(3, 'End_Time', end_time)
             tables[i] = t
@@ -256,7 +268,7 @@ def daily_table(data, f_weight, max_remove, lmax_override=None):
     return tables
 
 
-def lmax_spectra(data, table, f_weight, flags, summary=False, lmax_override={}):
+def lmax_spectra(data, table, f_weight, flags, summary=False, lmax_override={}, lookup=None):
 
     """
 
@@ -272,6 +284,7 @@ def lmax_spectra(data, table, f_weight, flags, summary=False, lmax_override={}):
     :param summary      : True for overall summary (tables[0]); False for daily summary (tables[1])
     :param lmax_override: Dict of integer values with which to override automatic Lmax (11th value), e.g.
                                 {'Daytime': 67, 'Night-time': 54}
+    :param lookup       : Output of lmax_lookup() for data and flags, to share between calls (created if None)
 
     :return             : Table in the same format as daily_tables(), with representative Lmax spectra
 
@@ -280,102 +293,155 @@ def lmax_spectra(data, table, f_weight, flags, summary=False, lmax_override={}):
 
     """
 
-    lmax = 'L' + f_weight + 'max_Main'
-    lmax_cols = data.filter(regex='max').columns.to_list()
+    if lookup is None:
+        lookup = lmax_lookup(data, f_weight, flags)
 
-    # Extract columns relating to 125-4000 Hz
-    narrow_cols = []
-    for c in lmax_cols:
-        if ('Hz' in c.split('_')) and (125 <= float(c.split('_')[c.split('_').index('Hz') - 1]) <= 4000):
-            narrow_cols.append(c)
+    lmax = 'L' + f_weight + 'max_Main'
+    lmax_cols = lookup['cols']
 
-    df_out = DataFrame()
+    df_out = []
 
     for f in flags:
 
-        # Filter data and summary table to period
-        df_tmp = data.dropna(subset=[f])[flags + lmax_cols].copy()
-        tab_tmp = table[table['Period'] == f.replace('Flag_', '')][[
-            'Day',
-            'Period',
-            'Start_Time',
-            'End_Time',
-            'L' + f_weight + 'max_Main'
-        ]].copy()
+        # Filter summary table to period
+        f_replace = f.replace('Flag_', '')
+        tab_tmp = table[table['Period'] == f_replace][['Day', 'Period', 'Start_Time', 'End_Time', lmax]]
 
         # Manual override
-        f_replace = f.replace('Flag_', '')
         if summary and (f_replace in lmax_override.keys()):
-            tab_tmp['L' + f_weight + 'max_Main'] = lmax_override[f_replace]
+            tab_tmp = tab_tmp.assign(**{lmax: lmax_override[f_replace]})
 
-        df_tmp[lmax + '_rnd'] = df_tmp[lmax].round(0)
-        tab_tmp[lmax + '_rnd'] = tab_tmp[lmax].round(0)
-
-        merge_left = [lmax + '_rnd']
-        merge_right = [lmax + '_rnd']
+        tab_rnd = round_(tab_tmp[lmax].values.astype(float))
+        period = lookup['periods'][f]
 
+        # Look up instances of each row's Lmax (on the same period-day for daily summary) in sorted samples
         if summary:
+            order, keys = period['order_rnd'], period['keys_rnd']
+            tab_keys = tab_rnd
+        else:
+            tab_days = tab_tmp.index.astype('<M8[ns]')
+            order, keys = period['order_day'], period['keys_day']
+            tab_keys = day_keys(tab_days.asi8 // NS_DAY, tab_rnd, period['rnd_min'], period['rnd_span'])
 
-            tab_tmp['day'] = 0
+        lo, hi = keys.searchsorted(tab_keys, 'left'), keys.searchsorted(tab_keys, 'right')
+        n = hi - lo
 
-        else:
+        row = arange(len(n)).repeat(n)
+        sample = period['pos'][order[arange(n.sum()) - (cumsum(n) - n).repeat(n) + lo.repeat(n)]]
+
+        # Squared distance of each instance's narrow band spectrum from the mean of all instances for its row
+        narrow = lookup['values'][sample][:, lookup['narrow']]
+        groups = (None, (cumsum(n) - n)[n > 0], n > 0)
+        square_sum = nansum((narrow - grouped_reduce(narrow, groups, 'mean')[row])**2, axis=1)
+
+        # Keep closest instance(s), or one empty row if Lmax isn't found
+        keep = square_sum == grouped_reduce(square_sum[:, None], groups, 'min')[row, 0]
+        row = concatenate([row[keep], flatnonzero(n == 0)])
+        sample = concatenate([sample[keep], full((n == 0).sum(), -1)])
+        row_order = argsort(row, kind='mergesort')
+        row, sample = row[row_order], sample[row_order]
+
+        values = lookup['values'][sample]
+        values[sample == -1] = nan
+
+        df_tmp = DataFrame(values, columns=lmax_cols)
+        for c in ['Day', 'Period', 'Start_Time', 'End_Time']:
+            df_tmp[c] = tab_tmp[c].values[row]
 
-            tab_tmp.index = tab_tmp.index.astype('<M8[ns]')
-
-            # Shift data by period's start time to account for overnight cases
-            t_start = to_timedelta(df_tmp[f][0].time().strftime('%H:%M:%S'))
-            df_tmp.index = df_tmp.index - t_start
-
-            # Prepare columns for matching
-            tab_tmp['day'] = tab_tmp.index.date
-            df_tmp['day'] = df_tmp.index.date
-            merge_left.append('day')
-            merge_right.append('day')
-
-        # Look up instances of each day's Lmax in filtered data
-        tab_tmp = tab_tmp.merge(
-            df_tmp,
-            left_on=merge_left,
-            right_on=merge_right,
-            how='left',
-            suffixes=['_table', '']
-        ).fillna(value={'day': 0}).drop(columns=[lmax + '_rnd'])
-
-        agg = tab_tmp[['day'] + narrow_cols].groupby('day').mean()
-        tab_tmp = tab_tmp.merge(
-            agg,
-            left_on='day',
-            right_index=True,
-            suffixes=['', '_tmp'],
-            how='left'
-        )
-
-        for c in narrow_cols:
-            tab_tmp[c + '_tmp'] = (tab_tmp[c] - tab_tmp[c + '_tmp'])**2
-
-        tab_tmp['square_sum'] = tab_tmp.filter(regex='_tmp').sum(axis=1)
-        agg = tab_tmp[['day', 'square_sum']].groupby('day').min().reset_index()
-        tab_tmp = tab_tmp.merge(
-            agg,
-            on=['day', 'square_sum'],
-            how='inner'
-        ).drop(columns=[s + '_tmp' for s in narrow_cols] + ['square_sum'])
+        if not summary:
+            df_tmp.index = tab_days[row] + to_timedelta(df_tmp['Start_Time'] + ':00').values
 
         # Combine with previous time periods
-        df_out = concat([df_out, tab_tmp])
+        df_out.append(df_tmp)
+
+    df_out = concat(df_out)
 
     if not summary:
         # Sort table
-        df_out.index = to_datetime(df_out['day'].astype(str) + ' ' + df_out['Start_Time'])
         df_out.sort_index(inplace=True)
         df_out.index = df_out.index.date
 
-    lmax_cols.sort(key=('L' + f_weight + 'max_Main').__eq__)
+    lmax_cols = sorted(lmax_cols, key=('L' + f_weight + 'max_Main').__eq__)
     df_spec_cols = ['Day', 'Period', 'Start_Time', 'End_Time'] + lmax_cols
 
     return df_out[df_spec_cols]     # .round(0)
 
 
+def lmax_lookup(data, f_weight, flags):
+
+    """
+
+    Returns samples of each time period sorted for the representative Lmax spectrum search in lmax_spectra(),
+    so that sorting is done once per dataset rather than once per table:
+
+        - cols      : Lmax columns (broadband and spectral)
+        - values    : 2D array of data in cols
+        - narrow    : positions in cols of 125-4000 Hz bands, used for least squares minimisation
+        - periods   : dict by flag of samples with Lmax in that period (positions in data), sorted by rounded Lmax
+                      (for overall summaries) and by period-day then rounded Lmax (for daily summaries)
+
+    """
+
+    lmax = 'L' + f_weight + 'max_Main'
+    columns = schema.of(data)
+    lmax_cols = columns.metric('L' + f_weight + 'max')
+
+    # Extract columns relating to 125-4000 Hz
+    narrow = []
+    for j, c in enumerate(lmax_cols):
+        if (columns.columns[c].frequency is not None) and (125 <= columns.columns[c].frequency <= 4000):
+            narrow.append(j)
+
+    rnd = round_(float_values(data[[lmax]])[:, 0])
+
+    periods = {}
+    for f in flags:
+
+        pos = flatnonzero(data[f].notna().values)
+
+        if len(pos) == 0:
+            continue
+
+        # Shift data by period's start time to account for overnight cases
+        t_start = to_timedelta(data[f].iloc[pos[0]].time().strftime('%H:%M:%S'))
+        days = (data.index[pos] - t_start).floor('1D').asi8 // NS_DAY
+
+        pos, days = pos[~isnan(rnd[pos])], days[~isnan(rnd[pos])]
+        rnd_min = rnd[pos].min() if len(pos) > 0 else 0
+        rnd_span = rnd[pos].max() - rnd_min + 1 if len(pos) > 0 else 1
+        keys_day = day_keys(days, rnd[pos], rnd_min, rnd_span)
+
+        order_rnd = argsort(rnd[pos], kind='mergesort')
+        order_day = argsort(keys_day, kind='mergesort')
+
+        periods[f] = {
+            'pos': pos,
+            'order_rnd': order_rnd,
+            'keys_rnd': rnd[pos][order_rnd],
+            'order_day': order_day,
+            'keys_day': keys_day[order_day],
+            'rnd_min': rnd_min,
+            'rnd_span': rnd_span
+        }
+
+    return {'cols': lmax_cols, 'values': float_values(data[lmax_cols]), 'narrow': narrow, 'periods': periods}
+
+
+def day_keys(days, rnd, rnd_min, rnd_span):
+
+    """
+
+    Returns single integer key for each (period-day, rounded Lmax) pair, in the same order as sorting by both
+    Rounded Lmax outside [rnd_min, rnd_min + rnd_span) (i.e. not present in data) gives -1, which matches nothing
+
+    """
+
+    offset = rnd - rnd_min
+    valid = (offset >= 0) & (offset < rnd_span)
+
+    return where(valid, days * int(rnd_span) + where(valid, offset, 0).astype('int64'), -1)
+
+
 def export_excel(data, metadata, tables, config):
 
     """
@@ -393,8 +459,17 @@ def export_excel(data, metadata, tables, config):
     file_out = config["output"][0] + ".xlsm"
     config_out = file_out.replace(".xlsm", "_config.txt")
 
+    # Restore Duration dropped in compact mode (see process.to_compact()), from index frequency if regular
+    if 'Duration' not in data.columns:
+        if isinstance(data.index.freq, Tick):
+            data = data.assign(Duration=Timedelta(data.index.freq))
+        else:
+            data = data.assign(Duration=Series(data.index, index=data.index).diff().shift(-1))
+
+    columns = schema.of(data)
+
     # Create summary
-    flags = data.filter(regex='^Flag_').columns.to_list()
+    flags = columns.flags()
     s1 = Series(
         index=[
             'Number of Time Samples',
@@ -428,8 +503,8 @@ def export_excel(data, metadata, tables, config):
 
     # Re-order columns
     cols = ['Address', 'Duration']
-    cols += data.filter(regex='_Main$').columns.to_list()
-    cols += data.filter(regex='Hz$').columns.to_list()
+    cols += columns.role('main')
+    cols += columns.role('band')
     cols += flags
     for c in data.columns:
         if c not in cols:
@@ -438,12 +513,12 @@ def export_excel(data, metadata, tables, config):
 
     # Replace flags' start times with booleans
     for f in flags:
-        data_out_tmp = data_out[f].dropna()
-        if data_out_tmp.empty:
-            data_out[f] = False
-        else:
-            t_start = data_out_tmp[0]
-            data_out[f] = data_out[f].replace({t_start: True, None: False})
+        data_out[f] = data_out[f].notna()
+
+    # Widen compact (float32) levels, so exported values are as read from file
+    compact = data_out.columns[[d == 'float32' for d in data_out.dtypes]]
+    if len(compact) > 0:
+        data_out[compact] = float_values(data_out[compact])
 
     # Collate tables
 
@@ -500,11 +575,235 @@ def export_excel(data, metadata, tables, config):
 
     print("Exporting to Excel...")
 
-    # Write data
+    # Write data (only header and first row of full data, remaining rows are streamed in on saving)
     summary.to_excel(writer, "Summary", header=False)
-    data_out.to_excel(writer, "Full_Data")
+    data_out.iloc[:1].to_excel(writer, "Full_Data")
     table_main.to_excel(writer, "Summary_Tables")
     table_leq_spec.to_excel(writer, "Leq_Spectral_Tables")
     table_lmax_spec.to_excel(writer, "Lmax_Spectral_Tables")
 
-    return writer, config_out
+    return TemplateWriter(writer, "Full_Data", data_out), config_out
+
+
+class TemplateWriter:
+
+    """
+
+    Saves output workbook in two steps, as writing a large Full_Data sheet cell by cell with openpyxl is slow and
+    memory-hungry:
+
+        1. Template and all other sheets saved by openpyxl as before (keeping VBA project, pivot tables and charts),
+           with header and first row of full data only
+        2. Remaining rows of full data streamed into the saved file's worksheet XML with stream_rows()
+
+    """
+
+    def __init__(self, writer, sheet, data):
+        self.writer = writer
+        self.sheet = sheet
+        self.data = data
+
+    def save(self, progress=None):
+
+        self.writer.save()
+
+        t = time()
+        stream_rows(self.writer.path, self.sheet, self.data, progress=progress)
+        t = time() - t
+
+        print("Full data exported: {} rows in {:.1f} s ({:.0f} rows/s)".format(
+            len(self.data), t, len(self.data) / max(t, 1e-6)
+        ))
+
+
+def stream_rows(file_out, sheet, data, chunksize=10000, progress=None):
+
+    """
+
+    Writes rows 2 onwards of data (with index as first column, as DataFrame.to_excel()) into given sheet of saved
+    workbook, after its header and first data row. Each column uses the cell style of its first row, so
+    number formats set by pandas (e.g. for dates and durations) are kept.
+
+    Worksheet XML is written in chunks of rows straight into a copy of the workbook, then replaces it.
+    Missing values are left as empty cells. If given, progress('Exporting rows', n_written, n_rows) is called after
+    each chunk.
+
+    """
+
+    if len(data) < 2:
+        return
+
+    with ZipFile(file_out) as z_in:
+
+        # Find worksheet by name
+        workbook = z_in.read('xl/workbook.xml').decode('utf-8')
+        rels = z_in.read('xl/_rels/workbook.xml.rels').decode('utf-8')
+        r_id = next(a['r:id'] for a in tag_attributes(workbook, 'sheet') if a.get('name') == sheet)
+        target = next(a['Target'] for a in tag_attributes(rels, 'Relationship') if a.get('Id') == r_id)
+        part = 'xl/' + re.sub(r'^/?(xl/)?', '', target)
+
+        xml = z_in.read(part).decode('utf-8')
+        head, rows = xml.split('<sheetData>', 1)
+        rows, tail = rows.split('</sheetData>', 1)
+        head = re.sub(r'(<dimension ref="[A-Z]+\d+:[A-Z]+)\d+', r'\g<1>' + str(len(data) + 1), head)
+
+        # Keep header and first row, and style of each column in first row
+        rows = [
+            r for r, a in zip(re.findall(r'<row\b[^>]*?/>|<row\b.*?</row>', rows), tag_attributes(rows, 'row'))
+            if a.get('r') in ('1', '2')
+        ]
+        styles = {
+            a['r'][:-1]: a['s'] for a in tag_attributes(''.join(rows), 'c') if a['r'].endswith('2') and ('s' in a)
+        }
+
+        cols = [data.index] + [data[c] for c in data.columns]
+        letters = [get_column_letter(j + 1) for j in range(len(cols))]
+
+        # Remove incomplete copy if interrupted (e.g. cancelled from progress function)
+        try:
+            with ZipFile(file_out + '.tmp', 'w', ZIP_DEFLATED) as z_out:
+                for item in z_in.infolist():
+
+                    if item.filename != part:
+                        z_out.writestr(item, z_in.read(item.filename))
+                        continue
+
+                    with z_out.open(part, 'w', force_zip64=True) as file:
+
+                        file.write((head + '<sheetData>' + ''.join(rows)).encode('utf-8'))
+
+                        for start in range(1, len(data), chunksize):
+
+                            stop = min(start + chunksize, len(data))
+                            row_nums = [str(r) for r in range(start + 2, stop + 2)]
+
+                            cells = [
+                                cell_strings(c[start:stop], letter, row_nums, styles.get(letter))
+                                for c, letter in zip(cols, letters)
+                            ]
+
+                            file.write(''.join(
+                                '<row r="' + r + '">' + ''.join(row) + '</row>'
+                                for r, row in zip(row_nums, zip(*cells))
+                            ).encode('utf-8'))
+
+                            if progress:
+                                progress('Exporting rows', stop, len(data))
+
+                        file.write(('</sheetData>' + tail).encode('utf-8'))
+        except BaseException:
+            remove(file_out + '.tmp')
+            raise
+
+    replace(file_out + '.tmp', file_out)
+
+
+def tag_attributes(xml, tag):
+
+    """
+
+    Returns list of attribute dicts of each element with given tag in xml, in order, e.g. [{'r': 'A2', 's': '3',
+    't': 'n'}, ...] for tag 'c'. Attributes may be in any order, and values are unescaped
+
+    """
+
+    return [
+        {k: unescape(v, {'&quot;': '"', '&apos;': "'"}) for k, v in re.findall(r'([\w:]+)="([^"]*)"', attrs)}
+        for attrs in re.findall(r'<' + tag + r'\b([^>]*)>', xml)
+    ]
+
+
+def cell_strings(values, letter, row_nums, style=None):
+
+    """
+
+    Returns list of worksheet XML cells for one column of values ('' for missing values), written as pandas and
+    openpyxl would: numbers (formatted as '%.16g'), booleans, dates and durations (as Excel serial days, see
+    excel_serials()) and inline strings, including 'inf' / '-inf' for infinite numbers
+
+    """
+
+    values = Series(values)
+    s = '' if style is None else ' s="' + style + '"'
+
+    if values.dtype.kind in 'Mm':
+        missing = values.isna().values
+        text = number_strings(excel_serials(values.values))
+        t = 'n'
+
+    elif values.dtype.kind == 'b':
+        missing = zeros(len(values), dtype=bool)
+        text = values.values.astype(int).astype(str)
+        t = 'b'
+
+    elif values.dtype.kind in 'iuf':
+        missing = values.isna().values
+        text = number_strings(values.values)
+        t = 'n'
+
+    else:
+        return [
+            cell_string(v, letter + r, s) for v, r in zip(values.values, row_nums)
+        ]
+
+    cells = [
+        '' if m else '<c r="' + letter + r + '"' + s + ' t="' + t + '"><v>' + v + '</v></c>'
+        for v, r, m in zip(text, row_nums, missing)
+    ]
+
+    if values.dtype.kind == 'f':
+        for j in flatnonzero(isinf(values.values)):
+            cells[j] = cell_string(values.values[j], letter + row_nums[j], s)
+
+    return cells
+
+
+def excel_serials(values):
+
+    """
+
+    Returns Excel serial days of datetime64 or timedelta64 array, calculated as openpyxl (for datetimes) or pandas
+    (for durations) would, so streamed values match rows written by openpyxl to the last digit:
+        - datetimes     : whole days since EXCEL_EPOCH, plus seconds and microseconds (nanoseconds are dropped) as
+                          a fraction of a day
+        - durations     : seconds / 86400
+
+    """
+
+    ns = values.view('int64')
+
+    if values.dtype.kind == 'm':
+        return ns / 1e9 / 86400
+
+    days, ns_day = divmod(ns - EXCEL_EPOCH, NS_DAY)
+
+    return days + (ns_day // 10**9 + ns_day % 10**9 // 1000 / 10**6) / 86400
+
+
+def number_strings(values):
+
+    """
+
+    Returns list of numbers formatted as openpyxl writes them, i.e. '%.16g' (e.g. '57' for 57.0)
+
+    """
+
+    return ['%.16g' % v for v in values.tolist()]
+
+
+def cell_string(value, ref, s):
+
+    if value is None or value != value:
+        return ''
+    if isinstance(value, (bool, bool_)):
+        return '<c r="' + ref + '"' + s + ' t="b"><v>' + str(int(value)) + '</v></c>'
+    if isinstance(value, datetime):
+        value = excel_serials(array([Timestamp(value).value], dtype='datetime64[ns]'))[0]
+    elif isinstance(value, timedelta):
+        value = excel_serials(array([Timedelta(value).value], dtype='timedelta64[ns]'))[0]
+    if isinstance(value, (int, float, number)) and isinf(value):
+        value = 'inf' if value > 0 else '-inf'
+    elif isinstance(value, (int, float, number)):
+        return '<c r="' + ref + '"' + s + ' t="n"><v>' + '%.16g' % value + '</v></c>'
+
+    return '<c r="' + ref + '"' + s + ' t="inlineStr"><is><t>' + escape(str(value)) + '</t></is></c>'
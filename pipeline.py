@@ -0,0 +1,178 @@
+# Processing pipeline for one survey, shared by the GUI (NoiseDataProcessor_ui.py) and batch runner (batch.py)
+#   read_data.read() -> process.process_batch() -> outputs_ui.daily_table() -> outputs_ui.export_excel()
+
+import infer_filetype
+import cache
+import incremental
+import columnar
+import outputs_ui
+import profiling
+from read_data import read
+from process import process_batch, split_chunk_modules, to_compact
+from json import dumps
+from time import time
+
+REQUIRED_FIELDS = [
+    'input',
+    'output',
+    'type',
+    'modules',
+    'lmax summary remove',
+]
+
+
+def run(config, timings=None, progress=None, profile=None):
+
+    """
+
+    Reads, processes and summarises survey set up in config, then prepares Excel output
+
+    :param config       : Config dict, as loaded from config file (with input / output set)
+    :param timings      : Dict to which time taken by each stage (s) is added, i.e. read, process, tables, export
+    :param progress     : Function called as progress(stage, done, total) through each stage, e.g.
+                          progress('Running modules', 2, 5); total is 0 if progress within stage is unknown
+    :param profile      : profiling.Profile to which each stage is added (and then saving, by save()), or None
+
+    :return             : (writer, config_out) from outputs_ui.export_excel(), to pass to save(); or None in
+                          incremental mode if there are no new data files
+
+    """
+
+    for f in REQUIRED_FIELDS:
+        if f not in config.keys():
+            raise Exception("Config file is missing " + f)
+
+    if timings is None:
+        timings = {}
+
+    t = time()
+
+    # Infer file type if config set to auto
+    if config["type"] == "auto":
+        file_type = infer_filetype.infer(config["input"][0])
+        print("\nInferred file type: " + file_type)
+    else:
+        file_type = config["type"]
+
+    # Read input data
+    print("Reading data...")
+    if progress:
+        progress('Reading files', 0, 0)
+
+    user_metadata = config["percentiles"].copy()
+    user_metadata.insert(0, config["frequency weighting"])
+
+    workers = config.get("workers", 1)
+    modules = config["modules"]
+
+    read_args = {}
+    if 'columns' in config.keys():
+        read_args['columns'] = config["columns"]
+    if 'time format' in config.keys():
+        read_args['time_format'] = config["time format"]
+
+    # Read large CSV files in chunks, applying leading Regularise / Re-sample modules to each chunk
+    if (file_type == 'custom_csv') and config.get("chunk size"):
+        read_args['chunksize'] = config["chunk size"]
+        read_args['modules'], modules = split_chunk_modules(modules)
+
+    # In incremental mode, only read data files not already included in the state file
+    if config.get("incremental"):
+        files_new, read_args['skip'] = incremental.new_files(config["incremental"], file_type, config["input"])
+        if not files_new:
+            return None
+
+    with profiling.stage(profile, 'read') as record:
+
+        # Use cached data if input files are unchanged since last run
+        if config.get("cache"):
+            data, metadata = cache.read(
+                file_type, config["input"], user_metadata, workers,
+                cache_dir=config["cache"], max_size=config.get("cache size", 1024), progress=progress, **read_args
+            )
+        else:
+            data, metadata = read(file_type, config["input"], user_metadata, workers, progress, **read_args)
+
+        # Store levels as float32, flags as categoricals and no Duration column, to reduce memory use
+        if config.get("compact"):
+            data = to_compact(data)
+
+        profiling.set_output(record, data)
+
+    print("Data read successfully")
+    timings['read'], t = time() - t, time()
+
+    # Run pre-processing modules, dropping spectra not used by summary tables if pruning
+    prune = None
+    if config.get("prune columns"):
+        prune = outputs_ui.unused_spectra(data, metadata["Frequency Weighting"])
+
+    data, _ = process_batch(data, modules, metadata, progress, profile, config.get("compact", False), prune)
+    timings['process'], t = time() - t, time()
+
+    if progress:
+        progress('Building tables', 0, 0)
+
+    # Generate output tables (in incremental mode, from stored state for all data, although only new data is
+    # exported to Full_Data)
+    with profiling.stage(profile, 'tables', data):
+        if config.get("incremental"):
+            tables = incremental.update(
+                config["incremental"],
+                data,
+                files_new,
+                metadata["Frequency Weighting"],
+                config["lmax summary remove"]
+            )
+        else:
+            tables = outputs_ui.daily_table(
+                data,
+                metadata["Frequency Weighting"],
+                config["lmax summary remove"],
+                config["lmax summary override"]
+            )
+
+    timings['tables'], t = time() - t, time()
+
+    # Export processed data and tables to Parquet files for fast reloading (before export_excel(), which
+    # modifies tables)
+    if config.get("columnar output"):
+        with profiling.stage(profile, 'columnar export', data):
+            columnar.export(data, metadata, tables, config)
+
+    # Prepare Excel export
+    if progress:
+        progress('Preparing export', 0, 0)
+
+    with profiling.stage(profile, 'export', data):
+        writer, config_out = outputs_ui.export_excel(data, metadata, tables, config)
+    timings['export'] = time() - t
+
+    return writer, config_out
+
+
+def save(writer, config, config_out, progress=None, profile=None):
+
+    """
+
+    Saves Excel output and config duplicate (raises PermissionError if output file is open)
+    progress is called as in run(), for saving workbook and streaming full data rows
+    If profile is given, saving is added to it and report of all stages written next to config duplicate
+
+    """
+
+    # Export workbook
+    if progress:
+        progress('Saving workbook', 0, 0)
+
+    with profiling.stage(profile, 'save', writer.data):
+        writer.save(progress)
+
+    # Export config file
+    with open(config_out, 'w') as file:
+        file.write(dumps(config, indent=4))
+
+    if profile is not None:
+        profile.write(config_out.replace("_config.txt", "_profile.json"), config)
+
+    print("Export complete")
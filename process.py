@@ -1,12 +1,24 @@
 # Data processing modules
 
-from numpy import log10
-from pandas import date_range, DataFrame, to_timedelta
+from numpy import log10, nan, full, zeros, arange, isnan, bincount, cumsum, concatenate, lexsort, argsort, diff, \
+    minimum, where, round_, floor, ceil, fmin, add, errstate, partition, take_along_axis, flatnonzero, array, isin
+from pandas import date_range, DataFrame, DatetimeIndex, RangeIndex, Categorical, Timestamp, to_timedelta, concat
 from pandas.tseries.offsets import BusinessHour, Hour
+from pandas.tseries.frequencies import to_offset
 from datetime import datetime
+from itertools import groupby
+import profiling
+import schema
 
+# Decimal places of compact (float32) levels kept when widening to float64 for processing, which removes float32
+# representation error (e.g. 55.3 stored as 55.29999924) for levels below 1000 dB
+COMPACT_DECIMALS = 4
 
-def regularise_noise(data, args):
+NS_MINUTE = 60 * 10**9
+MINUTES_DAY = 24 * 60
+
+
+def regularise_noise(data, args, drop=None):
 
     """
 
@@ -19,6 +31,11 @@ def regularise_noise(data, args):
         - resolution (pandas offset alias): output resolution of data
         - drop_ends (bool): if True, removes first and last data points
 
+    drop = columns to leave out of output, e.g. pruned by process_batch() (None to keep all)
+
+    Entries are placed in a grid of blank rows by regular_slots() with a single reindex (one copy of the data)
+    Auxiliary output is a DataFrame of duplicated and missing slots, as regular_slots()
+
     """
 
     resolution, drop_ends = args
@@ -26,25 +43,114 @@ def regularise_noise(data, args):
     if type(resolution) == int:
         resolution = str(resolution) + "T"
 
-    # Snap to resolution
-    data.index = data.index.round(resolution)
+    rows, slots, grid, report = regular_slots(data.index, resolution, drop_ends.lower() == "true")
+
+    # Source row of each slot of grid (-1 for missing or duplicated)
+    source = full(len(grid), -1)
+    source[slots] = rows
+
+    # Place entries in grid, blank (NaN) where source is -1
+    data_out = data.copy(deep=False)
+    data_out.index = RangeIndex(len(data))
+    if drop:
+        data_out = data_out.reindex(index=source, columns=[c for c in data.columns if c not in set(drop)])
+    else:
+        data_out = data_out.reindex(source)
+    data_out.index = grid
+
+    return data_out, report
+
+
+def regular_slots(index, resolution, drop_ends=False):
+
+    """
+
+    Returns slots of regular grid at resolution for times in index, as (rows, slots, grid, report):
+        - rows              : positions in index of entries kept (i.e. not duplicated), in time order
+        - slots             : position in grid of each kept entry
+        - grid              : DatetimeIndex of slots from first to last kept entry (without these if drop_ends)
+        - report            : DataFrame of duplicated and missing slots, indexed by time:
+                                - Status    : 'Duplicated' (all entries in slot removed) or 'Missing' (no entries)
+                                - Entries   : number of entries in slot
+
+    Each entry's slot is found from its integer snapped time, and duplicates from one pass over sorted slots
+
+    """
+
+    step = to_offset(resolution).nanos
+
+    # Snap to resolution, then find unique and duplicated slots from sorted times
+    times = index.round(resolution).asi8
+    order = argsort(times, kind='mergesort')
+    times_sorted = times[order]
+
+    first = flatnonzero(concatenate(([True], times_sorted[1:] != times_sorted[:-1]))[:len(times)])
+    entries = diff(concatenate((first, [len(times)])))
+    single = entries == 1
+
+    rows = order[first[single]]
+    slot_times = times_sorted[first[single]]
+
+    if len(slot_times) > 0:
+        slots = (slot_times - slot_times[0]) // step
+        grid = date_range(Timestamp(slot_times[0]), periods=slots[-1] + 1, freq=resolution, name='Time')
+    else:
+        slots = zeros(0, dtype=int)
+        grid = DatetimeIndex([], freq=resolution, name='Time')
+
+    if drop_ends:
+        rows, slots, grid = rows[1:-1], slots[1:-1] - 1, grid[1:-1]
+
+    # Report duplicated and missing slots
+    duplicated = times_sorted[first[~single]]
+    missing = flatnonzero(bincount(slots, minlength=len(grid)) == 0)
+    missing = grid.asi8[missing][~isin(grid.asi8[missing], duplicated)]
+
+    report = concat([
+        DataFrame({'Status': 'Duplicated', 'Entries': entries[~single]}, index=DatetimeIndex(duplicated, name='Time')),
+        DataFrame({'Status': 'Missing', 'Entries': 0}, index=DatetimeIndex(missing, name='Time'))
+    ]).sort_index()
+
+    return rows, slots, grid, report
+
+
+def regularise_resample(data, reg_args, res_args, drop=None):
+
+    """
+
+    Returns data regularised and re-sampled, as regularise_noise() then resample_noise(), without padding data to the
+    regular grid: entries kept by regularisation are re-sampled directly, with the grid giving the input frequency and
+    number of samples of each period. Run by process_batch() for Regularise followed by Re-sample
+
+    :param reg_args     : Arguments of regularise_noise()
+    :param res_args     : Arguments of resample_noise()
+    :param drop         : Columns to leave out of output, or None
+
+    :return             : (data, [regularisation report, re-sampling auxiliary data])
+
+    """
+
+    resolution, drop_ends = reg_args
+
+    if type(resolution) == int:
+        resolution = str(resolution) + "T"
+
+    rows, slots, grid, report = regular_slots(data.index, resolution, drop_ends.lower() == "true")
 
-    # Remove duplicates and count bad entries
-    data_tmp = data.reset_index().drop_duplicates(subset='Time', keep=False).set_index('Time')
-    count_duplicates = data.shape[0] - data_tmp.shape[0]
-    data = data_tmp
+    cols = [j for j, c in enumerate(data.columns) if not drop or (c not in set(drop))]
+    data = data.iloc[rows, cols]
+    data.index = grid[slots]
 
-    # Pad missing entries
-    pad_idx = date_range(data.index.min(), data.index.max(), freq=resolution, name='Time')
-    data = data.resample(resolution).first().reindex(pad_idx)
+    # Padding would make integer and boolean columns float and object
+    if len(slots) < len(grid):
+        data = data.astype({c: float if d.kind in 'iu' else object for c, d in data.dtypes.items() if d.kind in 'iub'})
 
-    if drop_ends.lower() == "true":
-        data = data.drop(index=data.index[0]).drop(index=data.index[-1])
+    data, aux = resample_noise(data, res_args, grid)
 
-    return data, count_duplicates
+    return data, [report, aux]
 
 
-def resample_noise(data, args):
+def resample_noise(data, args, grid=None):
 
     """
 
@@ -70,6 +176,9 @@ def resample_noise(data, args):
         - 'End_Time'        : last
         -  None of the above: first
 
+    grid = DatetimeIndex of regular slots of data, if data are regularised without padding (see
+           regularise_resample()); sets input frequency, time span and number of samples in each period
+
     """
 
     res_out, max_remove, avg_type, f_weight, percentiles, leq_avg = args
@@ -83,11 +192,20 @@ def resample_noise(data, args):
         raise Exception("Average type for Leq re-sampling must be linear or log")
 
     cols = data.columns
-    resamp_idx = date_range(data.index.min().floor(res_out), data.index.max(), freq=res_out, name='Time')
-    data_out = DataFrame()
+    columns = schema.of(data)
+    span = data.index if grid is None else grid
+    resamp_idx = date_range(span.min().floor(res_out), span.max(), freq=res_out, name='Time')
+
+    # Group once: every aggregation below shares the same re-sampled period codes
+    codes = bin_codes(data.index, resamp_idx)
+    n_groups = len(resamp_idx)
+    groups = grouped_segments(codes, n_groups)
+
+    # Output columns, collated by name and assembled into one DataFrame at the end
+    out = {}
 
     # Count missing samples
-    freq_in, freq_out = data.index.freq, resamp_idx.freq
+    freq_in, freq_out = span.freq, resamp_idx.freq
 
     if freq_in == BusinessHour():
         freq_in = Hour()
@@ -97,98 +215,422 @@ def resample_noise(data, args):
     n = freq_out / freq_in
 
     if n >= 1:
-        data_tmp = DataFrame(index=data.index)
-        data_tmp['Missing Samples'] = 1
-        data_tmp = n - data_tmp.filter(regex='Missing Samples').resample(res_out).sum().reindex(resamp_idx)
-        data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
+        samples = codes if grid is None else bin_codes(grid, resamp_idx)
+        out['Missing Samples'] = n - bincount(samples, minlength=n_groups)
     else:
-        data_out['Missing Samples'] = 0
-
-    # Leq dependant on input arguments
-
-    # Log average for Leq (if used as pre-processing module)
-    if leq_avg == 'log':
+        out['Missing Samples'] = zeros(n_groups)
 
-        data_tmp = 10**(data.filter(regex='^L' + f_weight + 'eq')/10)
+    def add(cols_tmp, values):
+        for j, c in enumerate(cols_tmp):
+            if c not in out:
+                out[c] = values[:, j]
 
-        if len(data_tmp.columns) > 0:
-            data_tmp = data_tmp.resample(res_out).mean().reindex(resamp_idx)
-            data_tmp = 10 * log10(data_tmp)
-            data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
+    # Leq dependant on input arguments
+    cols_tmp = columns.metric('L' + f_weight + 'eq')
 
-    # Linear average for Leq (if used for summary table generation)
-    elif leq_avg == 'linear':
+    if len(cols_tmp) > 0:
 
-        data_tmp = data.filter(regex='^L' + f_weight + 'eq')
+        # Log average for Leq (if used as pre-processing module)
+        if leq_avg == 'log':
+            add(cols_tmp, 10 * log10(grouped_reduce(10**(float_values(data[cols_tmp])/10), groups, 'mean')))
 
-        if len(data_tmp.columns) > 0:
-            data_tmp = data_tmp.resample(res_out).mean().reindex(resamp_idx)
-            data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
+        # Linear average for Leq (if used for summary table generation)
+        elif leq_avg == 'linear':
+            add(cols_tmp, grouped_reduce(float_values(data[cols_tmp]), groups, 'mean'))
 
     # Minimum for Lmin / Start Time
-    cols_tmp = data.filter(regex='^L' + f_weight + 'min').columns.to_list()
-    data_tmp = data[cols_tmp].resample(res_out).min().reindex(resamp_idx)
+    cols_tmp = columns.metric('L' + f_weight + 'min')
 
-    if len(data_tmp.columns) > 0:
-        data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
+    if len(cols_tmp) > 0:
+        add(cols_tmp, grouped_reduce(float_values(data[cols_tmp]), groups, 'min'))
 
     # Maximum for Lmax (after excluding highest max_remove entries in each re-sampled period)
-    data_tmp = data.filter(regex='^L' + f_weight + 'max')
+    cols_tmp = columns.metric('L' + f_weight + 'max')
 
-    if len(data_tmp.columns) > 0:
-        data_tmp = data_tmp.resample(res_out).transform(lambda x: x.nlargest(max_remove + 1).min())
-        data_tmp = data_tmp.resample(res_out).max().reindex(resamp_idx)
-        data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
+    if len(cols_tmp) > 0:
+        add(cols_tmp, nth_largest(float_values(data[cols_tmp]), codes, n_groups, max_remove))
 
-    # Percentiles
+    # Percentiles (named as str(p), so percentiles read from metadata as floats, e.g. 'LA90.0', match no columns
+    # and fall through to first below, as before)
     #  - Perhaps output histograms to inform choices
     for p in percentiles:
 
-        data_tmp = data.filter(regex='^L' + f_weight + str(p).zfill(2))
+        cols_tmp = columns.metric('L' + f_weight + str(p).zfill(2))
 
-        if len(data_tmp.columns) > 0:
+        if len(cols_tmp) > 0:
 
             if avg_type == 'mean':
-                data_tmp = data_tmp.resample(res_out).mean().reindex(resamp_idx)
-            elif avg_type == 'mode':
-                data_tmp = data_tmp.resample(res_out).apply(lambda x: x.round(0).mode().min()).reindex(resamp_idx)
-            elif avg_type == 'median':
-                data_tmp = data_tmp.resample(res_out).median().reindex(resamp_idx)
-            elif avg_type == 'lq':
-                data_tmp = data_tmp.resample(res_out).quantile(0.25).reindex(resamp_idx)
-
-            data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
-
-    # Log sum for LE
-    data_tmp = 10**(data.filter(regex='^L' + f_weight + 'E')/10)
+                add(cols_tmp, grouped_reduce(float_values(data[cols_tmp]), groups, 'mean'))
+            else:
+                add(cols_tmp, grouped_stats(float_values(data[cols_tmp]), codes, n_groups, [avg_type])[avg_type])
 
-    if len(data_tmp.columns) > 0:
-        data_tmp = data_tmp.resample(res_out).sum().reindex(resamp_idx)
-        data_tmp = 10 * log10(data_tmp)
-        data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
+    # Log sum for LE (periods without data give -inf, as log of zero energy)
+    cols_tmp = columns.metric('L' + f_weight + 'E')
 
-    # Last for End Time
-    if 'End_Time' in data.columns:
-        data_tmp = data[['End_Time']].resample(res_out).last().reindex(resamp_idx)
-        data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
+    if len(cols_tmp) > 0:
+        with errstate(divide='ignore'):
+            add(cols_tmp, 10 * log10(grouped_reduce(10**(float_values(data[cols_tmp])/10), groups, 'sum')))
 
-    # First for everything else
-    remainder = []
-    for c in cols:
-        if c not in data_out.columns:
-            remainder.append(c)
+    # Last for End Time, first for everything else (any dtype, so use pandas)
+    remainder = [c for c in cols if (c not in out) and (c != 'End_Time')]
 
-    data_tmp = data[remainder].resample(res_out).first().reindex(resamp_idx)
+    if 'End_Time' in cols:
+        out['End_Time'] = data['End_Time'].groupby(codes).last().reindex(range(n_groups)).values
 
-    if len(data_tmp.columns) > 0:
-        data_out = data_out.merge(data_tmp, left_index=True, right_index=True, how='outer')
+    if len(remainder) > 0:
+        data_tmp = data[remainder].groupby(codes).first().reindex(range(n_groups))
+        for c in remainder:
+            out[c] = data_tmp[c].values
 
+    data_out = DataFrame(out, index=resamp_idx)
     data_out['Duration'] = to_timedelta(res_out)
     # What are columns [*, Over, Under, Pause] and how do we deal with them?
 
     return data_out[cols], 'No auxiliary data'
 
 
+def resample_percentiles(data, res_out, avg_types):
+
+    """
+
+    Returns re-sampled DataFrame of percentile columns (e.g. LA10, LA90) for several averaging types in one pass
+    Output columns are suffixed by averaging type, e.g. ['LA90_Main_mean', 'LA90_Main_mode', 'LA90_Main_lq']
+
+    data = Input DataFrame (percentile columns only)
+    res_out = output resolution, e.g. '1D' for one day
+    avg_types = list of averaging types; can be mean, median, mode or lq (lower quartile)
+
+    """
+
+    if type(res_out) == int:
+        res_out = str(res_out) + 'T'
+
+    resamp_idx = date_range(data.index.min().floor(res_out), data.index.max(), freq=res_out, name='Time')
+    stats = grouped_stats(float_values(data), bin_codes(data.index, resamp_idx), len(resamp_idx), avg_types)
+
+    data_out = DataFrame(index=resamp_idx)
+    for avg_type in avg_types:
+        for j, c in enumerate(data.columns):
+            data_out[c + '_' + avg_type] = stats[avg_type][:, j]
+
+    return data_out
+
+
+def resample_periods(data, flags, max_remove, f_weight, percentiles, avg_types):
+
+    """
+
+    Returns daily summary of every time period created with flag_periods(), in one grouped pass over all periods
+
+    Each sample is keyed by (period, period-day), with days shifted by the period's start time to account for
+    overnight cases. Samples in overlapping periods are repeated once per period they fall in; samples in no period
+    are left out. Output has one row per period-day with data, in order of flags then day, indexed by start of
+    period-day, with columns:
+        - Period                : name of period, e.g. 'Daytime' for 'Flag_Daytime'
+        - Start_Time, End_Time  : first and last sample times
+        - 'LAeq'                : log average
+        - 'LAmax'               : maximum, after removing highest max_remove entries
+        - 'LA##'                : suffixed by each averaging type, as resample_percentiles()
+
+    data = Input DataFrame
+    flags = list of flag columns, e.g. ['Flag_Daytime', 'Flag_Night-time']
+    max_remove = for Lmax, number of highest entries to ignore in each period-day
+    f_weight = frequency weighting
+    percentiles = list of percentile values in input
+    avg_types = list of averaging types for percentiles; can be mean, median, mode or lq (lower quartile)
+
+    """
+
+    idx = data.index
+    names, t_starts, positions, periods, days = [], [], [], [], []
+
+    for f in flags:
+
+        pos = flatnonzero(data[f].notna().values)
+
+        if len(pos) == 0:
+            continue
+
+        t_start = to_timedelta(data[f].iloc[pos[0]].time().strftime('%H:%M:%S'))
+
+        names.append(f.replace('Flag_', ''))
+        t_starts.append(t_start.value)
+        positions.append(pos)
+        periods.append(full(len(pos), len(names) - 1))
+        days.append((idx[pos] - t_start).floor('1D').asi8)
+
+    if not names:
+        return DataFrame(columns=['Period', 'Start_Time', 'End_Time'])
+
+    # Rows are in (period, day) order as data is time-sorted, so each new key starts a group
+    positions, periods, days = concatenate(positions), concatenate(periods), concatenate(days)
+    new_group = concatenate([[True], (diff(periods) != 0) | (diff(days) != 0)])
+    codes = cumsum(new_group) - 1
+    n_groups = codes[-1] + 1
+    groups = grouped_segments(codes, n_groups)
+
+    first = flatnonzero(new_group)
+    last = concatenate([first[1:], [len(codes)]]) - 1
+
+    out = {
+        'Period': array(names, dtype=object)[periods[first]],
+        'Start_Time': idx[positions[first]].values,
+        'End_Time': idx[positions[last]].values
+    }
+
+    def values(cols_tmp):
+        return float_values(data[cols_tmp])[positions]
+
+    columns = schema.of(data)
+
+    # Log average for Leq
+    cols_tmp = columns.metric('L' + f_weight + 'eq')
+
+    if len(cols_tmp) > 0:
+        leq = 10 * log10(grouped_reduce(10**(values(cols_tmp)/10), groups, 'mean'))
+        for j, c in enumerate(cols_tmp):
+            out[c] = leq[:, j]
+
+    # Maximum for Lmax (after excluding highest max_remove entries in each period-day)
+    cols_tmp = columns.metric('L' + f_weight + 'max')
+
+    if len(cols_tmp) > 0:
+        lmax = nth_largest(values(cols_tmp), codes, n_groups, max_remove)
+        for j, c in enumerate(cols_tmp):
+            out[c] = lmax[:, j]
+
+    # Percentiles
+    cols_tmp = []
+    for p in percentiles:
+        cols_tmp += columns.metric('L' + f_weight + schema.percentile(p))
+
+    if len(cols_tmp) > 0:
+        stats = grouped_stats(values(cols_tmp), codes, n_groups, avg_types)
+        for avg_type in avg_types:
+            for j, c in enumerate(cols_tmp):
+                out[c + '_' + avg_type] = stats[avg_type][:, j]
+
+    day_start = days[first] + array(t_starts)[periods[first]]
+
+    return DataFrame(out, index=DatetimeIndex(day_start, name='Time'))
+
+
+def grouped_stats(values, codes, n_groups, avg_types):
+
+    """
+
+    Returns dict of 2D arrays (one row per group) of each requested statistic for all columns of values:
+        - 'mean'    : mean
+        - 'mode'    : lowest mode after rounding to nearest integer, from histogram of counts per group
+        - 'median'  : median
+        - 'lq'      : lower quartile (linear interpolation)
+
+    Equivalent to re-sampling with mean(), apply(lambda x: x.round(0).mode().min()), median() and quantile(0.25)
+    NaN values are ignored; groups with no values give NaN
+
+    """
+
+    out = {a: full((n_groups, values.shape[1]), nan) for a in avg_types}
+    starts = concatenate([[0], cumsum(bincount(codes, minlength=n_groups))[:-1]])
+
+    quantiles = [(a, q) for a, q in [('median', 0.5), ('lq', 0.25)] if a in avg_types]
+    padded = grouped_padded(values, codes, n_groups) if quantiles else None
+
+    # Quantiles for all columns at once: sort each group's samples (NaN last) and interpolate by position
+    if padded is not None:
+
+        padded.sort(axis=2)
+        count = (~isnan(padded)).sum(axis=2)
+
+        for a, q in quantiles:
+            pos = q * (count - 1)
+            lo = take_along_axis(padded, floor(pos).clip(0).astype(int)[:, :, None], axis=2)[:, :, 0]
+            hi = take_along_axis(padded, ceil(pos).clip(0).astype(int)[:, :, None], axis=2)[:, :, 0]
+            out[a] = where(count == 0, nan, lo + (pos - floor(pos)) * (hi - lo))
+
+        quantiles = []
+
+    for j in range(values.shape[1]):
+
+        v = values[:, j]
+        valid = ~isnan(v)
+        count = bincount(codes, weights=valid, minlength=n_groups).astype(int)
+        empty = count == 0
+
+        if 'mean' in avg_types:
+            total = bincount(codes, weights=where(valid, v, 0), minlength=n_groups)
+            out['mean'][~empty, j] = total[~empty] / count[~empty]
+
+        if ('mode' in avg_types) and valid.any():
+            v_int = round_(v[valid])
+            v_min = v_int.min()
+            n_bins = int(v_int.max() - v_min) + 1
+            hist = bincount(
+                codes[valid] * n_bins + (v_int - v_min).astype(int), minlength=n_groups * n_bins
+            ).reshape(n_groups, n_bins)
+            out['mode'][:, j] = where(empty, nan, hist.argmax(axis=1) + v_min)
+
+        # Sort by group, then ascending value with NaN last
+        if quantiles:
+            v_sorted = v[lexsort((v, codes))]
+
+            for a, q in quantiles:
+                pos = q * (count - 1)
+                lo = starts + floor(pos).clip(0).astype(int)
+                hi = starts + ceil(pos).clip(0).astype(int)
+                lo, hi = lo.clip(max=len(v) - 1), hi.clip(max=len(v) - 1)
+                frac = pos - floor(pos)
+                out[a][:, j] = where(empty, nan, v_sorted[lo] + frac * (v_sorted[hi] - v_sorted[lo]))
+
+    return out
+
+
+def bin_codes(idx, resamp_idx):
+
+    """
+
+    Returns integer position of the re-sampled period in resamp_idx containing each timestamp in idx
+    Periods are [resamp_idx[i], resamp_idx[i + 1]), consistent with DataFrame.resample() for the same resolution
+
+    """
+
+    return resamp_idx.searchsorted(idx, side='right') - 1
+
+
+def grouped_segments(codes, n_groups):
+
+    """
+
+    Returns (order, starts, non_empty) describing contiguous segments of each group, for use with grouped_reduce()
+        - order     : stable sort of rows by group (None if rows are already in group order, i.e. time-sorted)
+        - starts    : first row of each non-empty group once sorted
+        - non_empty : boolean mask of groups containing at least one row
+
+    """
+
+    order = None
+    if (len(codes) > 1) and (diff(codes) < 0).any():
+        order = argsort(codes, kind='mergesort')
+
+    counts = bincount(codes, minlength=n_groups)
+    non_empty = counts > 0
+    starts = (cumsum(counts) - counts)[non_empty]
+
+    return order, starts, non_empty
+
+
+def grouped_reduce(values, groups, how):
+
+    """
+
+    Returns 2D array (one row per group) reducing all columns of a 2D float array at once, ignoring NaN:
+        - 'sum'     : sum (0 for groups with no values)
+        - 'mean'    : mean (NaN for groups with no values)
+        - 'min'     : minimum (NaN for groups with no values)
+
+    groups = output of grouped_segments()
+
+    """
+
+    order, starts, non_empty = groups
+
+    if order is not None:
+        values = values[order]
+
+    out = full((len(non_empty), values.shape[1]), nan)
+
+    if len(starts) == 0:
+        return out
+
+    if how == 'min':
+        out[non_empty] = fmin.reduceat(values, starts, axis=0)
+        return out
+
+    valid = ~isnan(values)
+    total = add.reduceat(where(valid, values, 0), starts, axis=0)
+
+    if how == 'sum':
+        out[:] = 0
+        out[non_empty] = total
+    elif how == 'mean':
+        with errstate(invalid='ignore'):
+            out[non_empty] = total / add.reduceat(valid.astype(int), starts, axis=0)
+
+    return out
+
+
+def grouped_padded(values, codes, n_groups, max_ratio=2):
+
+    """
+
+    Returns 3D array [group, column, sample in group] of a 2D array's values, padded with NaN to the largest group
+    Allows sorting / partitioning within every group and column in one call
+
+    Returns None if there are no values, or if padding would use more than max_ratio times the memory of the input
+    (i.e. group sizes are very uneven), in which case callers fall back to sorting column by column
+
+    """
+
+    counts = bincount(codes, minlength=n_groups)
+
+    if (len(codes) == 0) or (n_groups * counts.max() > max_ratio * len(codes)):
+        return None
+
+    order = argsort(codes, kind='mergesort')
+    codes_sorted = codes[order]
+    pos = arange(len(codes)) - (cumsum(counts) - counts)[codes_sorted]
+
+    padded = full((n_groups, values.shape[1], counts.max()), nan)
+    padded[codes_sorted, :, pos] = values[order]
+
+    return padded
+
+
+def nth_largest(values, codes, n_groups, n):
+
+    """
+
+    Returns (n + 1)th highest value for each group and column of a 2D array, i.e. maximum after removing n highest
+    If a group has n or fewer values, returns its lowest value; if it has none (or only NaN), returns NaN
+    Equivalent to groupby(codes).transform(lambda x: x.nlargest(n + 1).min()) for all columns at once
+
+    values      : 2D float array, one row per sample
+    codes       : group of each row, as returned by bin_codes()
+    n_groups    : number of groups (rows in output)
+
+    """
+
+    padded = grouped_padded(values, codes, n_groups)
+
+    # All columns at once: partition each group's samples (NaN last) about the (n + 1)th highest
+    if padded is not None:
+
+        count = (~isnan(padded)).sum(axis=2)
+        kth = min(n, padded.shape[2] - 1)
+        top = -partition(-padded, kth, axis=2)[:, :, kth]
+
+        return where(count > n, top, fmin.reduce(padded, axis=2))
+
+    out = full((n_groups, values.shape[1]), nan)
+
+    # First row of each group once sorted by group
+    starts = concatenate([[0], cumsum(bincount(codes, minlength=n_groups))[:-1]])
+
+    for j in range(values.shape[1]):
+
+        v = values[:, j]
+        valid = ~isnan(v)
+        count = bincount(codes, weights=valid, minlength=n_groups).astype(int)
+
+        # Sort by group, then descending value with NaN last
+        v_sorted = v[lexsort((-v, codes))]
+
+        pos = starts + minimum(n, count - 1).clip(0)
+        out[:, j] = where(count > 0, v_sorted[pos.clip(max=len(v) - 1)], nan)
+
+    return out
+
+
 def flag_periods(data, args):
 
     """
@@ -231,52 +673,83 @@ def flag_periods(data, args):
 
     """
 
-    period_name = args[0]
-    t_start = datetime.strptime(args[1], '%d/%m/%y %H:%M')
-    t_end = datetime.strptime(args[2], '%d/%m/%y %H:%M')
+    return flag_periods_all(data, [args])
+
+
+def flag_periods_all(data, periods):
+
+    """
+
+    Flags several periods (each given as args of flag_periods()) in one pass over the data, as run by process_batch()
+    for consecutive Flag time modules:
+        1. Minute of week of each sample (Monday 00:00 = 0) is computed once from the integer index, as period start
+           and end times are whole minutes
+        2. Recurring periods are set in a table of bitmasks by minute of week (bit i for periods[i]), so all are
+           flagged by a single lookup of each sample's bitmask
+        3. One-off periods are set in the same bitmask, by comparing integer times
+
+    Each period's flag is stored as a categorical of its start time, i.e. one byte per sample with the start time
+    stored once (non-null in the period, as before)
+
+    """
+
+    if len(periods) > 64:
+        data, _ = flag_periods_all(data, periods[:64])
+        return flag_periods_all(data, periods[64:])
+
+    bit_type = next(t for t in ['uint8', 'uint16', 'uint32', 'uint64'] if int(t[4:]) >= len(periods))
+
+    times = data.index.asi8
+    minutes = times // NS_MINUTE
+    week_minutes = (minutes // MINUTES_DAY + 3) % 7 * MINUTES_DAY + minutes % MINUTES_DAY    # 1/1/1970 was Thursday
+
+    # Minute of day and weekday of each entry of bitmask table
+    table_minutes = arange(7 * MINUTES_DAY)
+    table_days, table_minutes = table_minutes // MINUTES_DAY, table_minutes % MINUTES_DAY
+
+    table = zeros(7 * MINUTES_DAY, dtype=bit_type)
+    one_off = []
+    starts = []
+
+    for i, args in enumerate(periods):
 
-    # if args[3] == 'False':
-    #     recurrence = False
-    # else:
-    #     rec_tmp = args[3].replace(' ', '').split(',')
-    #     recurrence = []
-    #     for r in rec_tmp:
-    #         recurrence.append(int(r))
+        t_start = datetime.strptime(args[1], '%d/%m/%y %H:%M')
+        t_end = datetime.strptime(args[2], '%d/%m/%y %H:%M')
+        recurrence = args[3]
+        bit = table.dtype.type(1 << i)
+        starts.append(t_start)
 
-    recurrence = args[3]
+        if recurrence:
 
-    if recurrence:
+            start = t_start.hour * 60 + t_start.minute
+            end = t_end.hour * 60 + t_end.minute
 
-        if t_end.time() > t_start.time():
+            if end > start:
+                in_period = (table_minutes >= start) & (table_minutes < end)
+            else:
+                # Overnight cases
+                in_period = (table_minutes >= start) | (table_minutes < end)
 
-            data['Flag_' + period_name] = \
-                (data.index.weekday.isin(recurrence)) & \
-                (data.index.time >= t_start.time()) &\
-                (data.index.time < t_end.time())
+            table[isin(table_days, recurrence) & in_period] |= bit
 
         else:
 
-            # Overnight cases
-            data['Flag_' + period_name] = \
-                (data.index.weekday.isin(recurrence)) & \
-                (
-                        (data.index.time >= t_start.time()) |
-                        (data.index.time < t_end.time())
-                )
+            one_off.append((bit, Timestamp(t_start).value, Timestamp(t_end).value))
 
-    else:
+    bitmask = table[week_minutes]
 
-        data['Flag_' + period_name] = \
-            (data.index >= t_start) & \
-            (data.index < t_end)
+    for bit, start, end in one_off:
+        bitmask[(times >= start) & (times < end)] |= bit
 
-    # Replace bool with start time
-    data['Flag_' + period_name] = data['Flag_' + period_name].replace({True: t_start, False: None})
+    # Store each period's flag with its start time
+    for i, args in enumerate(periods):
+        codes = where(bitmask & bitmask.dtype.type(1 << i), 0, -1).astype('int8')
+        data['Flag_' + args[0]] = Categorical.from_codes(codes, categories=DatetimeIndex([starts[i]]))
 
     return data, 'No auxiliary data'
 
 
-def remove_periods(data, args):
+def remove_periods(data, args, copy=True):
 
     """
 
@@ -285,6 +758,7 @@ def remove_periods(data, args):
     Inputs:
         data = Input DataFrame
         args = List of time periods to remove, as specified in flag_periods()
+        copy = False to blank entries in data itself, e.g. when fused with flagging by process_batch()
 
     Returns:
         df_out:     Output DataFrame
@@ -294,8 +768,8 @@ def remove_periods(data, args):
 
     args = ['Flag_' + f for f in args]
     # df_out = data[data[args].isnull().sum(axis=1) == len(args)]
-    df_out = data.copy()
-    df_out[df_out[args].isnull().sum(axis=1) != len(args)] = None
+    df_out = data.copy() if copy else data
+    df_out[data[args].notna().values.any(axis=1)] = None
     drop_count = len(data) - len(df_out)
 
     return df_out, drop_count
@@ -314,7 +788,8 @@ def third_to_octave(data, _):
 
     Returns:
         df:     Output DataFrame, reduced to octaves for each metric
-        df_aux: DataFrame showing which frequency bands contribute to each octave band
+        df_aux: DataFrame showing which frequency bands contribute to each octave band, one row per octave band of
+                each metric
 
     Assumptions:
 
@@ -335,63 +810,328 @@ def third_to_octave(data, _):
 
     """
 
-    df = data.copy()
-    df_aux = DataFrame(columns=['Output_Band', 'Input_1', 'Input_2', 'Input_3'])
-    metrics = df.filter(regex='Main').columns.to_list()
+    # Band columns of each metric with a broadband (Main) column, e.g. {'LAeq': ['LAeq_12.5_Hz', ...]}
+    columns = schema.of(data)
+    spectra = {m: c for m, c in columns.spectra().items() if columns.metric(m, 'main')}
 
-    for i, m in enumerate(metrics):
+    # Metrics with the same bands are converted together
+    band_sets = {}
+    for m, cols in spectra.items():
+        band_sets.setdefault(tuple(columns.columns[c].band for c in cols), []).append(m)
 
-        df_tmp = 10 ** (df.filter(regex=m.replace('_Main', '') + '.*Hz') / 10)
-        cols = df_tmp.columns.to_list()
+    drop = []
+    octaves = []
+    aux = []
 
-        for j, c in enumerate(cols[1::3]):
+    for bands, metrics in band_sets.items():
 
-            c0 = cols[3*j]
-            c1 = cols[3*j + 2]
+        groups = [(bands[3*j + 1], bands[3*j:3*j + 3]) for j in range(len(bands) // 3)]
+        if not groups:
+            continue
 
-            df_tmp[c] = df_tmp[c0] + df_tmp[c] + df_tmp[c1]
-            df_tmp.drop(columns=[c0, c1], inplace=True)
-            df.drop(columns=[c0, c1], inplace=True)
+        octaves.append(sum_bands(data, {m: spectra[m] for m in metrics}, groups))
 
-            df_aux.loc[m.replace('_Main', '')] = [c, c0, c, c1]
+        for m in metrics:
+            for band, members in groups:
+                drop += [m + '_' + b + '_Hz' for b in members if b != band]
+                aux.append([m] + [m + '_' + b + '_Hz' for b in (band,) + members])
 
-        df_tmp = 10 * log10(df_tmp)
+    # Octave levels replace their centre band, so columns stay in order
+    df = data.drop(columns=drop)
+    for o in octaves:
+        for c in o.columns:
+            df[c] = o[c].values
 
-        for j, c in enumerate(cols[1::3]):
-            df[c] = df_tmp[c]
+    df_aux = DataFrame(aux, columns=['Metric', 'Output_Band', 'Input_1', 'Input_2', 'Input_3']).set_index('Metric')
 
     return df, df_aux
 
 
-def process_batch(data, modules, metadata):
+def band_matrix(bands, groups):
 
-    module_names = {
-        "Regularise": regularise_noise,
-        "Re-sample": resample_noise,
-        "Flag time": flag_periods,
-        "Remove time": remove_periods,
-        "Convert to octaves": third_to_octave
-    }
+    """
+
+    Returns summation matrix of bands into groups, i.e. 1 where bands[i] is in group j, otherwise 0
+
+    :param bands        : List of bands, e.g. ['12.5', '16', '20', ...]
+    :param groups       : List of (output band, input bands), e.g. [('16', ['12.5', '16', '20']), ...]
+
+    """
+
+    index = {b: i for i, b in enumerate(bands)}
+    matrix = zeros((len(bands), len(groups)))
+
+    for j, (_, members) in enumerate(groups):
+        matrix[[index[b] for b in members], j] = 1
+
+    return matrix
+
+
+def sum_bands(data, spectra, groups):
+
+    """
+
+    Returns DataFrame of logarithmic sums of groups of bands for each metric, converting all metrics with one matrix
+    multiply in the energy domain. Groups can be any sets of bands, e.g. third-octaves into octaves (as
+    third_to_octave()), or a low-frequency sum [('LF', ['12.5', '16', ..., '160'])]
+    A group is NaN where any of its bands is NaN
+
+    :param data         : Input DataFrame
+    :param spectra      : Dict of band columns by metric, all with the same bands, as from schema.Schema.spectra()
+    :param groups       : List of (output band, input bands), as band_matrix()
+
+    :return             : DataFrame with columns 'Metric_Band_Hz' for each metric and output band, in that order
+
+    """
+
+    columns = schema.of(data).columns
+    bands = [columns[c].band for c in next(iter(spectra.values()))]
+    matrix = band_matrix(bands, groups)
+
+    # One row per sample and metric, one column per band
+    energy = 10 ** (float_values(data[[c for m in spectra for c in spectra[m]]]).reshape(-1, len(bands)) / 10)
+
+    missing = isnan(energy)
+    if missing.any():
+        energy[missing] = 0
+
+    with errstate(divide='ignore'):
+        levels = 10 * log10(energy @ matrix)
+
+    if missing.any():
+        levels[(missing @ matrix) > 0] = nan
+
+    return DataFrame(
+        levels.reshape(len(data), len(spectra) * len(groups)),
+        index=data.index,
+        columns=[m + '_' + band + '_Hz' for m in spectra for band, _ in groups]
+    )
+
+
+def module_args(mod, metadata):
+
+    """
+
+    Returns copy of module's arguments from config, e.g. ["Re-sample", ['15T', 10, 'mean']]
+    Incorporates frequency weighting and percentiles from metadata in the case of re-sampling
+
+    """
+
+    mod_args = mod[1].copy()
+
+    if mod[0] == 'Re-sample':
+        mod_args.append(metadata["Frequency Weighting"])
+        mod_args.append(list(map(float, metadata.filter(regex='Percentile').to_list())))
+        mod_args.append('log')
+
+    return mod_args
+
+
+def split_chunk_modules(modules):
+
+    """
+
+    Splits module list into leading modules that can be applied chunk-by-chunk while reading (Regularise and
+    Re-sample), and the remaining modules
+
+    """
+
+    n = 0
+    while (n < len(modules)) and (modules[n][0] in ['Regularise', 'Re-sample']):
+        n += 1
+
+    return modules[:n], modules[n:]
+
+
+MODULES = {
+    "Regularise": regularise_noise,
+    "Re-sample": resample_noise,
+    "Flag time": flag_periods,
+    "Remove time": remove_periods,
+    "Convert to octaves": third_to_octave
+}
+
+
+def plan_modules(modules, prune=None):
+
+    """
+
+    Returns plan of steps to run modules, built from config["modules"] before any data are processed. Compatible
+    modules are fused into one step:
+        - Regularise followed by Re-sample: regularised entries re-sampled without padding (regularise_resample())
+        - Consecutive Flag time modules: all periods flagged in one pass over the index (flag_periods_all())
+        - Flag time followed by Remove time: entries blanked in the flagged data, without a copy
+
+    Columns in prune are dropped in the first step if it is Regularise (in its one copy of the data), otherwise in a
+    step of their own before it
+
+    Each step is a dict:
+        - kind              : 'prune', 'module', 'regularise + re-sample' or 'flag'
+        - modules           : positions of modules run, e.g. [0, 1]
+        - drop              : columns dropped in step
+
+    """
+
+    steps = []
+    drop = list(prune) if prune else []
+
+    i = 0
+    while i < len(modules):
+
+        names = [m[0] for m in modules[i:]]
+
+        if names[:2] == ['Regularise', 'Re-sample']:
+            kind, n_run = 'regularise + re-sample', 2
+        elif names[0] == 'Flag time':
+            kind, n_run = 'flag', 1
+            while (n_run < len(names)) and (names[n_run] == 'Flag time'):
+                n_run += 1
+            if (n_run < len(names)) and (names[n_run] == 'Remove time'):
+                n_run += 1
+        else:
+            kind, n_run = 'module', 1
+
+        if drop and (names[0] != 'Regularise'):
+            steps.append({'kind': 'prune', 'modules': [], 'drop': drop})
+            drop = []
+
+        steps.append({'kind': kind, 'modules': list(range(i, i + n_run)), 'drop': drop})
+        drop = []
+        i += n_run
+
+    if drop:
+        steps.append({'kind': 'prune', 'modules': [], 'drop': drop})
+
+    return steps
+
+
+def explain(modules, prune=None):
+
+    """
+
+    Returns description of plan_modules() plan, one line per step, e.g.:
+        Plan: 4 modules in 2 steps
+            1. Modules 1-2: Regularise + Re-sample (['1T', 'False'] -> ['15T', 10, 'mean']), dropping 198 columns
+            2. Modules 3-4: Flag time (Day, Night)
+
+    """
+
+    steps = plan_modules(modules, prune)
+    lines = ['Plan: ' + str(len(modules)) + ' modules in ' + str(len(steps)) + ' steps']
+
+    for i, step in enumerate(steps):
+
+        mods = [modules[j] for j in step['modules']]
+
+        if step['kind'] == 'prune':
+            line = 'Drop ' + str(len(step['drop'])) + ' columns'
+        else:
+            line = step_name(step)[0].upper() + step_name(step)[1:] + ': '
+            if step['kind'] == 'flag':
+                line += ' + '.join(
+                    n + ' (' + ', '.join(a[0] if n == 'Flag time' else ', '.join(a) for n, a in group) + ')'
+                    for n, group in groupby([(m[0], m[1]) for m in mods], key=lambda m: m[0])
+                )
+            else:
+                line += ' + '.join(m[0] for m in mods)
+                if any(m[1] for m in mods):
+                    line += ' (' + ' -> '.join(str(m[1]) for m in mods) + ')'
+            if step['drop']:
+                line += ', dropping ' + str(len(step['drop'])) + ' columns'
+
+        lines.append('    ' + str(i + 1) + '. ' + line)
+
+    return '\n'.join(lines)
+
+
+def step_name(step):
+
+    first, last = step['modules'][0] + 1, step['modules'][-1] + 1
+
+    return 'module ' + str(first) if first == last else 'modules ' + str(first) + '-' + str(last)
+
+
+def run_step(data, step, modules, metadata):
+
+    """
+
+    Runs step of plan_modules() plan, returning (data, list of auxiliary data of each module in step)
+
+    """
+
+    if step['kind'] == 'prune':
+        return data.drop(columns=step['drop']), []
+
+    mods = [modules[j] for j in step['modules']]
+    args = [module_args(m, metadata) for m in mods]
+
+    if step['kind'] == 'regularise + re-sample':
+        return regularise_resample(data, args[0], args[1], step['drop'])
+
+    if step['kind'] == 'flag':
+
+        periods = [a for m, a in zip(mods, args) if m[0] == 'Flag time']
+        data, aux_tmp = flag_periods_all(data, periods)
+        data_aux = [aux_tmp] * len(periods)
+
+        if mods[-1][0] == 'Remove time':
+            data, aux_tmp = remove_periods(data, args[-1], copy=False)
+            data_aux.append(aux_tmp)
+
+        return data, data_aux
+
+    if step['drop']:
+        data, aux_tmp = regularise_noise(data, args[0], step['drop'])
+    else:
+        data, aux_tmp = MODULES[mods[0][0]](data, args[0])
+
+    return data, [aux_tmp]
+
+
+def process_batch(data, modules, metadata, progress=None, profile=None, compact=False, prune=None):
+
+    """
+
+    Runs pre-processing modules, returning processed DataFrame and list of auxiliary data (one item per module)
+    Modules are run in steps planned by plan_modules() (printed with explain()), some of them fused; data may be
+    modified in place
+
+    progress = optional function called as progress('Running modules', n_run, n_modules) before and after each step
+    profile = optional profiling.Profile, to which each step is added as a stage
+    compact = if True, output of each step is converted back to compact representation (see to_compact())
+    prune = optional list of columns to drop, e.g. spectra not used by summary tables (config "prune columns")
+
+    """
 
     print("\nPre-processing data...")
+    print(explain(modules, prune))
+
     data_aux = []
+    columns = schema.of(data)
 
-    for i, mod in enumerate(modules):
-        print('    Module ' + str(i + 1) + ' of ' + str(len(modules)) + ': ' + mod[0])
+    for step in plan_modules(modules, prune):
 
-        mod_func = module_names[mod[0]]
-        mod_args = mod[1].copy()
+        if step['kind'] == 'prune':
+            name = 'prune'
+        else:
+            name = step_name(step) + ': ' + ' + '.join(modules[j][0] for j in step['modules'])
+            if progress:
+                progress('Running modules', step['modules'][0], len(modules))
+
+        with profiling.stage(profile, name, data) as record:
+            data, aux_tmp = run_step(data, step, modules, metadata)
+            if compact:
+                data = to_compact(data)
+            profiling.set_output(record, data)
 
-        # Incorporate frequency weighting and percentiles from metadata in the case of re-sampling
-        if mod[0] == 'Re-sample':
-            mod_args.append(metadata["Frequency Weighting"])
-            mod_args.append(list(map(float, metadata.filter(regex='Percentile').to_list())))
-            mod_args.append('log')
+        # Update column schema, parsing only columns added by step
+        columns = schema.of(data, columns)
 
-        # Run module
-        data, aux_tmp = mod_func(data, mod_args)
         # Collate auxiliary data
-        data_aux.append(aux_tmp)
+        data_aux += aux_tmp
+
+    if progress:
+        progress('Running modules', len(modules), len(modules))
 
     print("Pre-processing successful")
 
@@ -402,3 +1142,59 @@ def process_batch(data, modules, metadata):
 
     return data, data_aux
 
+
+def to_compact(data):
+
+    """
+
+    Returns DataFrame in compact representation (config option "compact"), which all modules accept:
+        - Levels (numeric columns beginning with 'L') as float32
+        - Address as int32
+        - Flags as categoricals of their period's start time, i.e. one byte per sample with the start time stored
+          once, instead of a Timestamp object per sample
+        - Duration dropped, as implied by the index frequency (restored on export by outputs_ui.export_excel())
+
+    Columns already in compact form are left as they are, so it can be applied again after each module
+
+    """
+
+    dtypes = {}
+    for c in data.columns:
+        kind = data[c].dtype.kind
+        if c.startswith('L') and (kind in 'iuf') and (data[c].dtype != 'float32'):
+            dtypes[c] = 'float32'
+        if (c == 'Address') and (kind in 'iu') and (data[c].dtype != 'int32'):
+            dtypes[c] = 'int32'
+
+    flags = [c for c in data.columns if c.startswith('Flag_') and (data[c].dtype.name != 'category')]
+
+    if not dtypes and not flags and ('Duration' not in data.columns):
+        return data
+
+    data = data.drop(columns=[c for c in ['Duration'] if c in data.columns]).astype(dtypes)
+
+    for f in flags:
+        mask = data[f].notna().values
+        data[f] = Categorical.from_codes(
+            where(mask, 0, -1).astype('int8'), categories=DatetimeIndex(data[f].values[mask][:1])
+        )
+
+    return data
+
+
+def float_values(data):
+
+    """
+
+    Returns values of DataFrame as 2D float64 array, for processing in full precision
+    Compact (float32) columns are rounded to COMPACT_DECIMALS places, so values match those read from file
+
+    """
+
+    values = data.values.astype(float)
+
+    compact = [j for j, d in enumerate(data.dtypes) if d == 'float32']
+    if compact:
+        values[:, compact] = round_(values[:, compact], COMPACT_DECIMALS)
+
+    return values
@@ -0,0 +1,132 @@
+# Per-stage profiling of the processing pipeline, switched on with "profile": True in the config file
+#   - Wall time, CPU time and peak memory of each stage (read, each pre-processing module, tables, export, save),
+#     with number of rows and columns of data in and out
+#   - Written as JSON report next to the duplicate config file, e.g. 'Survey_profile.json' for output 'Survey'
+#   - Peak memory is traced with tracemalloc, which slows down allocation-heavy stages a little. It includes memory
+#     allocated by Python, numpy and pandas in this process only (not in worker processes for parallel reading)
+
+import tracemalloc
+from contextlib import contextmanager
+from json import dump
+from time import perf_counter, process_time
+from datetime import datetime
+
+
+class Profile:
+
+    """
+
+    Collects measurements of pipeline stages, each run in a `with profile.stage(name, data):` block (stages can't
+    be nested)
+
+    :param memory       : Trace peak memory of each stage (False to time stages without tracing overhead)
+
+    """
+
+    def __init__(self, memory=True):
+        self.stages = []
+        self.memory = memory
+
+    @contextmanager
+    def stage(self, name, data=None):
+
+        """
+
+        Measures stage run in with block. Yields dict of measurements, to which output data can be added with
+        set_output()
+
+        :param name         : Stage name, e.g. 'read', 'module 1: Regularise'
+        :param data         : Input DataFrame, if any
+
+        """
+
+        record = {'stage': name}
+        record.update(shape(data, 'in'))
+
+        # Restart tracing so peak is measured from start of stage
+        if self.memory:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            tracemalloc.start()
+
+        wall, cpu = perf_counter(), process_time()
+
+        try:
+            yield record
+        finally:
+            record['wall time (s)'] = round(perf_counter() - wall, 4)
+            record['cpu time (s)'] = round(process_time() - cpu, 4)
+            if self.memory:
+                record['peak memory (MB)'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+                tracemalloc.stop()
+
+            self.stages.append(record)
+
+    def write(self, file_out, config):
+
+        """
+
+        Writes report of all stages to JSON file, with totals and input / output files from config
+
+        """
+
+        report = {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'input': config["input"],
+            'output': config["output"][0],
+            'wall time (s)': round(sum(s['wall time (s)'] for s in self.stages), 4),
+            'cpu time (s)': round(sum(s['cpu time (s)'] for s in self.stages), 4),
+            'peak memory (MB)': max([s.get('peak memory (MB)', 0) for s in self.stages], default=0),
+            'stages': self.stages
+        }
+
+        with open(file_out, 'w') as file:
+            dump(report, file, indent=4)
+
+        print("Profile written: " + file_out)
+
+
+@contextmanager
+def stage(profile, name, data=None):
+
+    """
+
+    As Profile.stage() if profile is given, otherwise runs with block unmeasured
+
+    """
+
+    if profile is None:
+        yield {}
+    else:
+        with profile.stage(name, data) as record:
+            yield record
+
+
+def set_output(record, data):
+
+    """
+
+    Adds rows and columns of output DataFrame to stage record yielded by Profile.stage()
+
+    """
+
+    record.update(shape(data, 'out'))
+
+
+def shape(data, direction):
+
+    if data is None:
+        return {}
+
+    return {'rows ' + direction: int(data.shape[0]), 'columns ' + direction: int(data.shape[1])}
+
+
+def start(config):
+
+    """
+
+    Returns new Profile if profiling is switched on in config, otherwise None
+
+    """
+
+    return Profile() if config.get("profile") else None
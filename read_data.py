@@ -1,13 +1,38 @@
 # Read data files and convert to standard format DataFrames
 
-from pandas import read_csv, read_excel, DataFrame, Series, Index, MultiIndex, \
-    to_datetime, to_timedelta, to_numeric, concat
+from pandas import read_csv, read_excel, DataFrame, Series, Index, \
+    to_datetime, to_timedelta, to_numeric, concat, date_range
+from openpyxl import load_workbook
 import read_metadata
+import process
+import schema
 import find_data
 from datetime import datetime
+from os import path
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
+DUO_TIME_FORMAT = '%d/%m/%y %H:%M:%S:%f'
 
-def read(file_type, files, user_metadata, **columns):
+
+def read(file_type, files, user_metadata, workers=1, progress=None, **kwargs):
+
+    """
+
+    Returns standard format DataFrame and metadata Series for input files
+
+    Optional keyword arguments:
+        - columns       : for custom files, dict mapping standard column names to column names in file
+        - time_format   : for custom files, explicit datetime format of time column, e.g. '%d/%m/%Y %H:%M:%S'
+        - chunksize     : for custom CSV files, number of rows to read at a time (see custom_csv_chunked)
+        - modules       : for custom CSV files read in chunks, leading Regularise / Re-sample modules to apply
+                          to each chunk
+        - skip          : for NL-32 / NL-52 surveys, set of absolute paths of data files to leave out (e.g. files
+                          already processed in incremental mode)
+
+    progress = optional function called as progress('Reading files', n_read, n_files) as NL-32 / NL-52 files are read
+
+    """
 
     flag_metadata = False
 
@@ -30,6 +55,9 @@ def read(file_type, files, user_metadata, **columns):
     # Reset file type now data files have been identified
     file_type = file_type.replace('meta', '')
 
+    if kwargs.get('skip') and file_type in ['nl32_data', 'nl52_data']:
+        files = [f for f in files if path.abspath(f) not in kwargs['skip']]
+
     if not flag_metadata:
 
         metadata_idx = ['Frequency Weighting']
@@ -44,15 +72,7 @@ def read(file_type, files, user_metadata, **columns):
     # Read data, concatenating if more than one file is found
     if file_type == 'nl32_data':
 
-        if len(files) == 1:
-            data = nl32(files[0], metadata, flag_metadata)
-        else:
-            for f, file in enumerate(files):
-                data_tmp = nl32(file, metadata, flag_metadata)
-                if f == 0:
-                    data = data_tmp
-                else:
-                    data = concat([data, data_tmp])
+        data = read_files(nl32, files, workers, metadata, flag_metadata, progress=progress)
 
     if file_type == 'nl52_data':
 
@@ -70,15 +90,7 @@ def read(file_type, files, user_metadata, **columns):
             'Under'
         ]
 
-        if len(files) == 1:
-            data = nl52(files[0], metadata, metrics)
-        else:
-            for f, file in enumerate(files):
-                data_tmp = nl52(file, metadata, metrics)
-                if f == 0:
-                    data = data_tmp
-                else:
-                    data = concat([data, data_tmp])
+        data = read_files(nl52, files, workers, metadata, metrics, progress=progress)
 
     if file_type == 'duo_data':
         data = duo(files, metadata, spectral=False)
@@ -87,10 +99,16 @@ def read(file_type, files, user_metadata, **columns):
         data = duo(files, metadata, spectral=True)
 
     if file_type == 'custom_csv':
-        data = custom_csv(files[0], columns['columns'])
+        if kwargs.get('chunksize'):
+            data = custom_csv_chunked(
+                files[0], kwargs['columns'], kwargs['chunksize'], kwargs.get('time_format'),
+                kwargs.get('modules', []), metadata
+            )
+        else:
+            data = custom_csv(files[0], kwargs['columns'], kwargs.get('time_format'))
 
     if file_type == 'custom_excel':
-        data = custom_excel(files[0], columns['columns'])
+        data = custom_excel(files[0], kwargs['columns'])
 
     # Insert column of sequential integers
     if 'Address' not in data.columns:
@@ -100,9 +118,62 @@ def read(file_type, files, user_metadata, **columns):
         data['Duration'] = data.index
         data['Duration'] = to_timedelta(data['Duration'].shift(-1) - data.index)
 
+    # Parse column schema, used by modules and outputs to find columns
+    schema.of(data)
+
     return data, metadata
 
 
+def data_files(file_type, files):
+
+    """
+
+    Returns list of all files parsed by read() for the given input files, i.e. metadata file plus any data files
+    found from it
+
+    """
+
+    if file_type == 'nl32_metadata':
+        return [files[0]] + find_data.nl32(read_metadata.nl32(files[0]), files[0])
+
+    if file_type == 'nl52_metadata':
+        return [files[0]] + find_data.nl52(read_metadata.nl52(files[0]), files[0])
+
+    if file_type.startswith('duo') or file_type.startswith('custom'):
+        return [files[0]]
+
+    return list(files)
+
+
+def read_files(reader, files, workers, *args, progress=None):
+
+    """
+
+    Reads a list of data files with a reader function and concatenates them once
+
+    If workers > 1, files are parsed in parallel on a pool of processes
+    Output is sorted (stable) on Time, so is independent of the number of workers
+    If given, progress('Reading files', n_read, n_files) is called as each file is read
+
+    """
+
+    data_list = []
+
+    if (workers > 1) and (len(files) > 1):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for data_tmp in executor.map(reader, files, *[repeat(a) for a in args]):
+                data_list.append(data_tmp)
+                if progress:
+                    progress('Reading files', len(data_list), len(files))
+    else:
+        for file in files:
+            data_list.append(reader(file, *args))
+            if progress:
+                progress('Reading files', len(data_list), len(files))
+
+    return concat(data_list).sort_index(kind='mergesort')
+
+
 def nl32(file_in, metadata, flag_metadata):
 
     data = read_csv(file_in, index_col='Time', parse_dates=True)
@@ -124,12 +195,23 @@ def nl32(file_in, metadata, flag_metadata):
 
 def nl52(file_in, metadata, metrics):
 
-    idx_in = read_csv(file_in, usecols=range(2), skiprows=1, parse_dates=True, names=['filter', 'value'])
+    """
+
+    Reads an NL-52 AUTO_LEQ data file (RND) in a single pass
+
+    Each measurement in the file is a block of rows: a short header (Address, Start Time, Measurement Time, ...)
+    followed by one row per metric. Rows are read once, numbered by their occurrence of each key, then the metric
+    rows are pivoted into one wide row per measurement (e.g. the n-th 'Leq' row belongs to the n-th 'Start Time').
+
+    """
+
+    # Peek at first block to determine layout
+    idx_in = read_csv(file_in, usecols=range(2), skiprows=1, nrows=6, header=None, names=['filter', 'value'])
 
     if idx_in.iloc[3, 0] == 'Frequency Weighting':
         attended = True
         skiprows = 6
-        metrics.append('Pause')
+        metrics = metrics + ['Pause']
     else:
         attended = False
         skiprows = 4
@@ -137,40 +219,45 @@ def nl52(file_in, metadata, metrics):
     # TODO: return attended flag
     # TODO: print duration after read if attended
 
-    data_in = read_csv(file_in, skiprows=skiprows, parse_dates=True)
-    # Previously had usecols=range(14) for data_in. Removed for flexibility - will this cause problems?
+    header = read_csv(file_in, skiprows=skiprows, nrows=0).columns.to_list()
+    header[0] = 'filter'
+
+    # Read all rows (block headers and measurement values) at once
+    data_in = read_csv(file_in, skiprows=1, header=None, names=header, dtype=str)
+    data_in = data_in.dropna(subset=['filter'])
+    data_in.index = [data_in.groupby('filter').cumcount(), data_in['filter']]
 
     # Read measurement times and durations
     data = DataFrame()
-    data['Time'] = to_datetime(idx_in[idx_in['filter'] == 'Start Time'].reset_index(drop=True).iloc[:, -1])
-    data['Duration'] = to_timedelta(idx_in[idx_in['filter'] == 'Measurement Time'].reset_index(drop=True).iloc[:, -1])
-    data['Address'] = idx_in[idx_in['filter'] == 'Address'].reset_index(drop=True).iloc[:, -1].astype(int)
-
-    # Read measurement values
-    for metric in metrics:
+    data['Time'] = to_datetime(data_in.xs('Start Time', level=1).iloc[:, 1])
+    data['Duration'] = to_timedelta(data_in.xs('Measurement Time', level=1).iloc[:, 1])
+    data['Address'] = data_in.xs('Address', level=1).iloc[:, 1].astype(int)
 
-        if metric in ['Over', 'Under', 'Pause']:
+    # Read measurement values, pivoting one row per metric into one row per measurement
+    value_cols = [c for c in header[1:] if (c != 'Sub') and not c.startswith('Unnamed')]
+    flag_metrics = [m for m in metrics if m in ['Over', 'Under', 'Pause']]
+    level_metrics = [m for m in metrics if m not in flag_metrics]
 
-            data_metric = data_in[['Unnamed: 0', 'Main']][data_in['Unnamed: 0'] == metric]. \
-                reset_index(drop=True). \
-                add_prefix(metric + '_')
+    data_in = data_in[data_in['filter'].isin(metrics)][value_cols].unstack(level=1)
+    data_in.columns = [m + '_' + c for c, m in data_in.columns]
 
-        else:
+    level_cols = [m + '_' + c for m in level_metrics for c in value_cols]
+    flag_cols = [m + '_Main' for m in flag_metrics]
 
-            data_metric = data_in[data_in['Unnamed: 0'] == metric].\
-                reset_index(drop=True).\
-                add_prefix(metric + '_')
+    data = concat([
+        data,
+        data_in.reindex(columns=level_cols).apply(to_numeric, errors='coerce'),
+        data_in.reindex(columns=flag_cols)
+    ], axis=1, join='inner')
 
-        data_metric.drop(columns=data_metric.filter(regex='Unnamed').columns, inplace=True)
-
-        if metric + '_Sub' in data_metric.columns:
-            data_metric.drop(columns=[metric + '_Sub'], inplace=True)
-
-        if metric in ['Over', 'Under', 'Pause']:
-            data = data.merge(data_metric, left_index=True, right_index=True)
+    # Restore metric order
+    cols = ['Time', 'Duration', 'Address']
+    for metric in metrics:
+        if metric in flag_metrics:
+            cols.append(metric + '_Main')
         else:
-            # data = data.merge(data_metric.astype(float), left_index=True, right_index=True)
-            data = data.merge(data_metric.apply(to_numeric, errors='coerce'), left_index=True, right_index=True)
+            cols += [metric + '_' + c for c in value_cols]
+    data = data[cols]
 
     f_weight = metadata['Frequency Weighting']
 
@@ -210,37 +297,18 @@ def nl52(file_in, metadata, metrics):
 
 def duo(file_in, metadata, spectral):
 
-    # Read in data from all worksheets as dictionary
-    try:
-        data_dict = read_excel(
-            file_in, skiprows=8, index_col='Period start', skipfooter=1,
-            parse_dates=True, date_parser=lambda x: datetime.strptime(x, "%d/%m/%y %H:%M:%S:%f"),
-            sheet_name=None
-        )
-    except TypeError:
-        data_dict = read_excel(
-            file_in, skiprows=8, index_col='Period start', skipfooter=1,
-            parse_dates=True,
-            sheet_name=None
-        )
-
-    # Collate into single DataFrame
-    data = DataFrame()
-    for d in data_dict.values():
-        data = data.merge(d, left_index=True, right_index=True, how='outer')
-
-    if spectral:
+    # Read header rows and data from all worksheets in a single pass
+    data = []
+    wb = load_workbook(file_in, read_only=True, data_only=True)
 
-        # Read in multi-level column headers from all worksheets as dictionary
-        headers_dict = read_excel(file_in, skiprows=6, index_col=0, nrows=0, header=[2, 0], sheet_name=None)
+    for ws in wb.worksheets:
+        ws.reset_dimensions()
+        data.append(duo_sheet(list(ws.iter_rows(values_only=True)), spectral))
 
-        # Collate into single DataFrame
-        headers = DataFrame(columns=MultiIndex(levels=[[], []], codes=[[], []]))
-        for h in headers_dict.values():
-            headers = headers.merge(h, left_index=True, right_index=True, how='outer')
+    wb.close()
 
-        # Update DataFrame's headers
-        data.columns = headers.columns.map('_'.join)
+    # Collate into single DataFrame, aligning sheets on time
+    data = concat(data, axis=1, join='outer').sort_index()
 
     # Tidy up column headers
 
@@ -280,10 +348,84 @@ def duo(file_in, metadata, spectral):
     return data
 
 
-def custom_csv(file_in, columns):
+def duo_sheet(rows, spectral, header_row=8, band_row=6):
+
+    """
+
+    Converts the rows of one DUO worksheet into a DataFrame indexed by 'Period start'
+
+    Column names are taken from header_row; for spectral data they are joined with the band names in band_row
+    (e.g. 'Leq_1/3 Oct 12.5Hz'), forward filling blank header cells as pandas.read_excel(header=[2, 0]) does
+    Blank rows are skipped and the final (footer) row is dropped
+
+    """
+
+    n = len(rows[header_row])
+    header = [list(rows[header_row]), list(rows[band_row]) + [None] * (n - len(rows[band_row]))]
+
+    if spectral:
+        control = [True] * n
+        for h in header:
+            last = h[0]
+            for i in range(1, n):
+                if not control[i]:
+                    last = h[i]
+                if h[i] is None or h[i] == '':
+                    h[i] = last
+                else:
+                    control[i] = False
+                    last = h[i]
+        columns = [str(header[0][0])] + [str(a) + '_' + str(b) for a, b in zip(header[0][1:], header[1][1:])]
+    else:
+        columns = [str(c) for c in header[0]]
+
+    rows = [r[:n] + (None,) * (n - len(r)) for r in rows[header_row + 1:] if any(v is not None for v in r)]
+
+    data = DataFrame(rows[:-1], columns=columns)
+    data = data.set_index(columns[0])
+    data.index = duo_time(data.index)
+
+    return data
+
+
+def duo_time(idx, n_sample=10):
+
+    """
+
+    Converts DUO 'Period start' column to datetimes in one vectorised call
+
+    Text timestamps (e.g. '18/07/19 10:00:00:000') are parsed with DUO_TIME_FORMAT if a sample of rows matches it;
+    cells already stored as Excel dates are converted directly, rounding to DUO's millisecond resolution as openpyxl
+    can return them a microsecond out
+
+    """
+
+    sample = [t for t in idx[:n_sample] if isinstance(t, str)]
+
+    if sample and all(_matches_format(t, DUO_TIME_FORMAT) for t in sample):
+        return to_datetime(idx, format=DUO_TIME_FORMAT).rename('Period start')
+
+    return to_datetime(idx).round('ms').rename('Period start')
+
+
+def _matches_format(t, time_format):
+
+    try:
+        datetime.strptime(t, time_format)
+        return True
+    except ValueError:
+        return False
+
+
+def custom_csv(file_in, columns, time_format=None):
 
     idx = columns['Time']
-    data = read_csv(file_in, usecols=columns.values(), index_col=idx, parse_dates=True)
+
+    if time_format:
+        data = read_csv(file_in, usecols=columns.values(), index_col=idx)
+        data.index = to_datetime(data.index, format=time_format)
+    else:
+        data = read_csv(file_in, usecols=columns.values(), index_col=idx, parse_dates=True)
 
     columns_inv = {v: k for k, v in columns.items()}
     data = data.rename(columns=columns_inv)
@@ -292,6 +434,164 @@ def custom_csv(file_in, columns):
     return data
 
 
+def custom_csv_chunked(file_in, columns, chunksize, time_format, modules, metadata):
+
+    """
+
+    Reads a large custom CSV file chunksize rows at a time, so the full-resolution data need not be held in memory
+
+        1. Level columns (standard names beginning with 'L') are read as float32
+        2. Time column is parsed with time_format if given
+        3. Leading Regularise / Re-sample modules are applied to each chunk before it is stored
+
+    Assumes file is sorted by time. Each chunk is processed up to the last boundary of the coarsest module resolution
+    before its last regularised entry (i.e. last time not shared by several rows), and the rows after it are carried
+    over to the next chunk. Every module's output for a chunk then covers whole slots / periods up to that boundary,
+    so output matches applying the modules to the whole file, including gaps, duplicates and drop_ends.
+
+    """
+
+    idx = columns['Time']
+    columns_inv = {v: k for k, v in columns.items()}
+    dtype = {v: 'float32' for k, v in columns.items() if k.startswith('L')}
+
+    # Coarsest output resolution and (first) regularise resolution set how many rows to carry over
+    res_round, res_carry = None, None
+    for mod in modules:
+        res = _resolution(mod)
+        if (mod[0] == 'Regularise') and (res_round is None):
+            res_round = res
+        if (res_carry is None) or (to_timedelta(res) > to_timedelta(res_carry)):
+            res_carry = res
+
+    state = {'start': [None] * len(modules)}
+    data_out = []
+    carry = None
+    n_read = 0
+
+    for chunk in read_csv(file_in, usecols=columns.values(), dtype=dtype, chunksize=chunksize):
+
+        chunk.index = to_datetime(chunk.pop(idx), format=time_format).rename('Time')
+        chunk = chunk.rename(columns=columns_inv)
+
+        # Address and Duration as added by read() to the whole file, i.e. row number and time to next row (set for
+        # the last row of the previous chunk here, as it is always carried over)
+        if 'Address' not in chunk.columns:
+            chunk['Address'] = range(n_read, n_read + len(chunk))
+        if 'Duration' not in chunk.columns:
+            chunk['Duration'] = to_timedelta(chunk.index[1:] - chunk.index[:-1]).append(to_timedelta([None]))
+            if carry is not None:
+                carry.iloc[-1, carry.columns.get_loc('Duration')] = chunk.index[0] - time_last
+
+        n_read, time_last = n_read + len(chunk), chunk.index[-1]
+
+        if res_round is not None:
+            chunk.index = chunk.index.round(res_round)
+
+        if carry is not None:
+            chunk = concat([carry, chunk])
+
+        if res_carry is None:
+            data_out.append(chunk.iloc[:-1])
+            carry = chunk.iloc[-1:]
+            continue
+
+        # Rows in the same regularised slot are adjacent, and all removed by Regularise if more than one (the last
+        # slot may continue in the next chunk)
+        kept = chunk.index
+        if res_round is not None:
+            kept = kept[~kept.duplicated(keep=False) & (kept < kept[-1])]
+
+        if kept.empty:
+            carry = chunk
+            continue
+
+        boundary = kept[-1].floor(res_carry)
+        split = chunk.index >= boundary
+        carry = chunk[split]
+
+        if not split.all():
+            data_out.append(_process_chunk(chunk[~split], modules, metadata, state, boundary))
+
+    if carry is not None and not carry.empty:
+        data_out.append(_process_chunk(carry, modules, metadata, state, None))
+
+    data = concat(data_out)
+
+    # Chunks cover consecutive slots / periods, but concat() doesn't keep the index frequency, which summary tables
+    # use for end times
+    if modules and not data.empty:
+        grid = date_range(data.index[0], periods=len(data), freq=_resolution(modules[-1]), name='Time')
+        if data.index.equals(grid):
+            data.index = grid
+
+    return data
+
+
+def _process_chunk(data, modules, metadata, state, boundary):
+
+    """
+
+    Applies Regularise / Re-sample modules to one chunk for custom_csv_chunked()
+
+    Each module's output is padded with blank slots / periods from the previous chunk's boundary (or its own first
+    entry for the first chunk) to boundary, or to its last entry for the last chunk (boundary None)
+    drop_ends only removes the first entry of the first chunk output and the last entry of the last chunk
+
+    Returns None if there is nothing to output for chunk
+
+    """
+
+    for i, mod in enumerate(modules):
+
+        mod_args = process.module_args(mod, metadata)
+        res = _resolution(mod)
+        first = state['start'][i] is None
+
+        if mod[0] == 'Regularise':
+            data, _ = process.regularise_noise(data, [res, 'False'])
+        elif not data.empty:
+            data, _ = process.resample_noise(data, mod_args)
+
+        # Nothing to output before the first entry, or after the last (e.g. last chunk's only entry dropped)
+        if data.empty and (first or (boundary is None)):
+            return None
+
+        if first:
+            state['start'][i] = data.index[0]
+
+        end = data.index[-1] if boundary is None else boundary - to_timedelta(res)
+        pad_idx = date_range(state['start'][i], end, freq=res, name='Time')
+
+        if not data.index.equals(pad_idx):
+            data = data.reindex(pad_idx)
+            if (mod[0] == 'Re-sample') and ('Duration' in data.columns):
+                data['Duration'] = to_timedelta(res)
+
+        state['start'][i] = boundary
+
+        if (mod[0] == 'Regularise') and (mod_args[1].lower() == 'true'):
+            if first:
+                data = data.iloc[1:]
+            if boundary is None:
+                data = data.iloc[:-1]
+
+    return data
+
+
+def _resolution(mod):
+
+    """
+
+    Returns resolution of Regularise / Re-sample module as pandas offset alias, e.g. '15T' for 15 (minutes)
+
+    """
+
+    res = mod[1][0]
+
+    return str(res) + 'T' if type(res) == int else res
+
+
 def custom_excel(file_in, columns):
 
     idx = columns['Time']
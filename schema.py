@@ -0,0 +1,169 @@
+# Column schema of standard format DataFrames, parsed once from column names
+#   - Levels are named 'L{weighting}{statistic}_Main' (broadband) or 'L{weighting}{statistic}_{band}_Hz' (spectral),
+#     e.g. 'LAeq_Main', 'LA90_12.5_Hz'; time period flags 'Flag_{period}' (see process.flag_periods())
+#   - of(data) returns the schema of a DataFrame, parsed on first use and kept for as long as its columns are
+#     unchanged (pandas replaces the column index whenever columns are added, dropped or renamed), so columns are
+#     found by metric or role with dict lookups rather than regexes over all columns
+#   - Built at ingest by read_data.read(), and derived from the previous schema after each module by
+#     process.process_batch(), so only new column names are parsed
+
+import re
+from collections import namedtuple
+from weakref import ref
+
+# Statistic and weighting of level metrics, e.g. 'LAeq' -> ('A', 'eq'), 'LA90' -> ('A', '90'), 'LE' -> ('', 'E')
+LEVEL = re.compile(r'^L([A-Z]?)(eq|E|max|min|\d+)$')
+
+# Parsed column:
+#   - role          : 'main' (broadband, '_Main'), 'band' (spectral, '_Hz'), 'flag' ('Flag_') or 'other'
+#   - metric        : e.g. 'LAeq' for 'LAeq_Main' and 'LAeq_12.5_Hz', or 'Over' for 'Over_Main' (None if not main or
+#                     band)
+#   - weighting     : Frequency weighting of level metrics, e.g. 'A' (None if not a level)
+#   - statistic     : Statistic of level metrics, i.e. 'eq', 'E', 'max', 'min' or percentile, e.g. '90' (None if not
+#                     a level)
+#   - band          : Band as in column name, e.g. '12.5' (None if not band)
+#   - frequency     : Band frequency (Hz) as float, e.g. 12.5 (None if not band)
+Column = namedtuple('Column', ['role', 'metric', 'weighting', 'statistic', 'band', 'frequency'])
+
+# Schemas by id of column index, with weak reference to check index is still the same object
+_schemas = {}
+
+
+class Schema:
+
+    """
+
+    Parsed columns of a DataFrame, indexed by role and metric
+
+    :param columns      : Column names, in order
+    :param previous     : Schema to take already parsed columns from (e.g. of data before a module), or None
+
+    """
+
+    def __init__(self, columns, previous=None):
+
+        parsed = previous.columns if previous is not None else {}
+        self.columns = {c: parsed[c] if c in parsed else parse(c) for c in columns}
+
+        self._roles = {}
+        self._metrics = {}
+        for c, column in self.columns.items():
+            self._roles.setdefault(column.role, []).append(c)
+            if column.metric is not None:
+                self._metrics.setdefault(column.metric, []).append(c)
+
+        self._spectra = {}
+        for c in self._roles.get('band', []):
+            self._spectra.setdefault(self.columns[c].metric, []).append(c)
+
+    def metric(self, metric, role=None):
+
+        """
+
+        Returns columns of metric in column order, e.g. ['LAeq_Main', 'LAeq_12.5_Hz', ...] for 'LAeq'; or only
+        broadband or spectral columns if role is 'main' or 'band'
+
+        """
+
+        cols = self._metrics.get(metric, [])
+        if role is not None:
+            return [c for c in cols if self.columns[c].role == role]
+
+        return list(cols)
+
+    def role(self, role):
+
+        """
+
+        Returns columns with role ('main', 'band', 'flag' or 'other'), in column order
+
+        """
+
+        return list(self._roles.get(role, []))
+
+    def flags(self):
+
+        return self.role('flag')
+
+    def spectra(self):
+
+        """
+
+        Returns dict of band columns by metric, in column order, e.g. {'LAeq': ['LAeq_12.5_Hz', ...], 'LAmax': [...]}
+
+        """
+
+        return {m: list(c) for m, c in self._spectra.items()}
+
+
+def parse(column):
+
+    """
+
+    Returns Column parsed from column name
+
+    """
+
+    if not isinstance(column, str):
+        return Column('other', None, None, None, None, None)
+
+    if column.startswith('Flag_'):
+        return Column('flag', None, None, None, None, None)
+
+    band = None
+    frequency = None
+
+    if column.endswith('_Main'):
+        role, metric = 'main', column[:-5]
+    elif column.endswith('_Hz') and (column.count('_') >= 2):
+        role, (metric, band) = 'band', column[:-3].rsplit('_', 1)
+        try:
+            frequency = float(band)
+        except ValueError:
+            pass
+    else:
+        return Column('other', None, None, None, None, None)
+
+    level = LEVEL.match(metric)
+    weighting, statistic = level.groups() if level else (None, None)
+
+    return Column(role, metric, weighting, statistic, band, frequency)
+
+
+def of(data, previous=None):
+
+    """
+
+    Returns Schema of DataFrame, parsing its columns if not already done since they last changed
+
+    :param previous     : Schema to take already parsed columns from, e.g. of data before a module
+
+    """
+
+    columns = data.columns
+    key = id(columns)
+    entry = _schemas.get(key)
+
+    if (entry is None) or (entry[0]() is not columns):
+        entry = (ref(columns, lambda r, k=key: _forget(k, r)), Schema(columns, previous))
+        _schemas[key] = entry
+
+    return entry[1]
+
+
+def percentile(p):
+
+    """
+
+    Returns statistic of percentile as in column names, e.g. '05' for 5 or 5.0, '90' for 90
+
+    """
+
+    return str(int(p)).zfill(2) if float(p).is_integer() else str(p)
+
+
+def _forget(key, reference):
+
+    # Remove schema when its column index is deleted (unless key has already been reused)
+    if (key in _schemas) and (_schemas[key][0] is reference):
+        del _schemas[key]